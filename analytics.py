@@ -0,0 +1,161 @@
+#!/usr/bin/python
+import os
+import csv
+import math
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+
+LEVELS = (('second', 1, 3600), ('minute', 60, 24 * 60), ('hour', 3600, 24 * 365))
+FIELDS = ('occupied', 'on', 'toggles')
+
+
+class Store:
+    # rings of per cell sums at every resolution in one memory-mapped file: samples, occupied and shower on
+    # samples and valve toggles; a slot is cleared when its bucket comes round again
+    def __init__(self, path, height=None, width=None, levels=LEVELS, mode='r+'):
+        if height is None:
+            height, width = np.memmap(path, np.int64, 'r', shape=(2,)).tolist()
+        self.height = height
+        self.width = width
+        self.levels = {name: (resolution, length) for name, resolution, length in levels}
+        header = [height, width] + [length for _, _, length in levels]
+        layout = [(None, 'header', np.int64, (len(header),))]
+        for name, _, length in levels:
+            layout += [(name, 'time', np.int64, (length,)), (name, 'samples', np.uint32, (length,))]
+            layout += [(name, field, np.uint32, (length, height, width)) for field in FIELDS]
+        offsets = []
+        size = 0
+        for _, _, dtype, shape in layout:
+            offsets.append(size)
+            size += -(-np.dtype(dtype).itemsize * int(np.prod(shape)) // 8) * 8
+        is_new = (not os.path.exists(path) or os.path.getsize(path) != size or
+                  np.memmap(path, np.int64, 'r', shape=(len(header),)).tolist() != header)
+        if is_new and mode == 'r':
+            raise ValueError('{} is not an analytics file'.format(path))
+        self._file = np.memmap(path, np.uint8, 'w+' if is_new else mode, shape=(size,))
+        self.rings = {name: {} for name in self.levels}
+        for (name, field, dtype, shape), offset in zip(layout, offsets):
+            array = np.ndarray(shape, dtype, buffer=self._file, offset=offset)
+            if name is None:
+                self.header = array
+            else:
+                self.rings[name][field] = array
+        if is_new:
+            self.header[:] = header
+            for ring in self.rings.values():
+                ring['time'].fill(-1)
+
+    def add(self, second, samples, sums):
+        for name, (resolution, length) in self.levels.items():
+            ring = self.rings[name]
+            bucket = second // resolution
+            slot = bucket % length
+            if ring['time'][slot] != bucket:
+                for array in ring.values():
+                    array[slot] = 0
+                ring['time'][slot] = bucket
+            ring['samples'][slot] += samples
+            for field, values in zip(FIELDS, sums):
+                ring[field][slot] += values
+
+    def query(self, level, start, end):
+        # fractions of the samples a cell was occupied and its shower on, and its toggles, in [start, end)
+        resolution, _ = self.levels[level]
+        ring = self.rings[level]
+        buckets = ring['time']
+        selected = (buckets >= start // resolution) & (buckets < math.ceil(end / resolution))
+        samples = int(ring['samples'][selected].sum())
+        return {
+            'samples': samples,
+            'buckets': int(selected.sum()),
+            'occupied': ring['occupied'][selected].sum(0) / max(samples, 1),
+            'on': ring['on'][selected].sum(0) / max(samples, 1),
+            'toggles': ring['toggles'][selected].sum(0),
+        }
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self.rings = {}
+        self.__dict__.pop('header', None)
+        self._file = None
+
+
+def export_heatmap(path, values):
+    with open(path, 'w', newline='') as file:
+        csv.writer(file).writerows(np.round(values, 4).tolist())
+
+
+class Recorder(threading.Thread):
+    # the engine adds every tick to the sums of the current second, a fixed cost; every full second is handed
+    # over to this thread, which folds it into the store
+    def __init__(self, store):
+        super().__init__(daemon=True)
+        self.store = store
+        self._second = None
+        self._samples = 0
+        self._sums = np.zeros((len(FIELDS), store.height, store.width), np.uint32)
+        self._last_on = None
+        self._queue = queue.Queue()
+
+    def sample(self, now, occupied, is_on):
+        second = int(now)
+        if second != self._second:
+            if self._samples:
+                self._queue.put((self._second, self._samples, self._sums))
+                self._sums = np.zeros_like(self._sums)
+            self._second = second
+            self._samples = 0
+        self._sums[0] += occupied
+        self._sums[1] += is_on
+        if self._last_on is None:
+            self._last_on = is_on.copy()
+        self._sums[2] += is_on != self._last_on
+        self._last_on[:] = is_on
+        self._samples += 1
+
+    def stop(self):
+        # the engine has stopped, so the current second is handed over as well
+        if self._samples:
+            self._queue.put((self._second, self._samples, self._sums))
+            self._samples = 0
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self.store.add(*item)
+        self.store.flush()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='prints or exports a heatmap from an analytics file')
+    parser.add_argument('path', nargs='?', default='analytics.dat')
+    parser.add_argument('--level', choices=[name for name, _, _ in LEVELS], default='hour')
+    parser.add_argument('--since', type=float, default=24, help='hours back from now')
+    parser.add_argument('--field', choices=FIELDS, default='occupied')
+    parser.add_argument('--csv', help='write the heatmap to this file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    store = Store(args.path, mode='r')
+    end = time.time()
+    result = store.query(args.level, end - args.since * 3600, end)
+    if args.csv:
+        export_heatmap(args.csv, result[args.field])
+    print('{} samples in {} buckets, {}:'.format(result['samples'], result['buckets'], args.field))
+    print(np.round(result[args.field], 3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import json
+import threading
+import urllib.parse
+import urllib.request
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from grid import Grid
+from render import decimate
+
+COMMANDS = ('activate', 'on_all', 'off_all', 'set_sens', 'set_origin', 'set_all_points', 'set_lidar',
+            'learn_background', 'align', 'set_mode', 'switch')
+
+
+class ApiServer:
+    # local HTTP API of a controller: GET /status, /settings, /frame and /analytics?level=&since=,
+    # POST /<command> with keyword arguments in JSON
+    def __init__(self, controller, port, voxel=40, max_points=400):
+        self.controller = controller
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, code, body):
+                body = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                if path == '/analytics':
+                    try:
+                        kwargs = {key: value if key == 'level' else float(value)
+                                  for key, value in urllib.parse.parse_qsl(query)}
+                        self._reply(200, controller.analytics(**kwargs))
+                    except Exception as e:
+                        self._reply(400, {'error': str(e)})
+                elif path == '/status':
+                    self._reply(200, controller.status())
+                elif path == '/settings':
+                    self._reply(200, controller.settings)
+                elif path == '/frame':
+                    states, is_on, scans = controller.frame()
+                    self._reply(200, {'states': states.tolist(), 'is_on': is_on.tolist(),
+                                      'scans': [decimate(points, voxel, max_points).tolist() for points in scans]})
+                else:
+                    self._reply(404, {'error': 'unknown path'})
+
+            def do_POST(self):
+                command = self.path.strip('/')
+                if command not in COMMANDS:
+                    self._reply(404, {'error': 'unknown command'})
+                    return
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    getattr(controller, command)(**json.loads(self.rfile.read(length) or b'{}'))
+                except Exception as e:
+                    self._reply(400, {'error': str(e)})
+                    return
+                self._reply(200, controller.status())
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class Client:
+    # stands in for a Controller in the GUI when it runs in another process; grid mirrors the remote geometry
+    def __init__(self, url, timeout=2.0):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.settings = self._request('/settings')
+        self.grid = Grid(self.settings)
+
+    def _request(self, path, body=None):
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(self.url + path, data, {'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def __getattr__(self, name):
+        if name not in COMMANDS:
+            raise AttributeError(name)
+        return lambda **kwargs: self._request('/' + name, kwargs)
+
+    def status(self):
+        status = self._request('/status')
+        grid = self.grid
+        if (status['x0'], status['y0']) != (grid.x0, grid.y0):
+            grid.x0, grid.y0 = status['x0'], status['y0']
+            grid.x1 = grid.x0 + grid.width * (grid.h + 1)
+            grid.y1 = grid.y0 + grid.height * (grid.h + 1)
+        grid.sens = status['sens']
+        return status
+
+    def frame(self):
+        frame = self._request('/frame')
+        self.grid.is_on[:] = frame['is_on']
+        return (np.array(frame['states'], np.uint8), self.grid.is_on.copy(),
+                [np.array(points).reshape(-1, 2) for points in frame['scans']])
+
+    def analytics(self, **kwargs):
+        return self._request('/analytics?' + urllib.parse.urlencode(kwargs))
+
+    def observe(self, stage, seconds):
+        pass
+
+    def close(self):
+        self.grid.close()
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+import os
+import time
+import shutil
+import struct
+import timeit
+import argparse
+import tempfile
+import numpy as np
+import modbus_tk.defines as cst
+from modbus_tk import hooks, modbus_tcp
+from bus import Dispatcher, OFF
+from engine import Engine
+from grid import Grid
+from lidar import Lidar, transform_points, transform_revolution, trig_table
+from replay import Recorder, RECORD, SUFFIX
+from tracking import Tracker
+
+
+def revolution(size, seed=0):
+    rng = np.random.default_rng(seed)
+    angles = np.sort(rng.uniform(0, 360, size))
+    distances = rng.uniform(150, 6000, size)
+    return angles, distances
+
+
+def bench_transform(sizes=(360, 720, 1500, 3000), repeat=5):
+    bounds = (400, -60, 400 + 5 * 601, -60 + 4 * 601, 600)
+    table = trig_table(0)
+    table_lists = table[0].tolist(), table[1].tolist()
+    print('{:>6} {:>12} {:>12} {:>8}'.format('points', 'loop, ms', 'numpy, ms', 'speedup'))
+    for size in sizes:
+        angles, distances = revolution(size)
+        angles_list, distances_list = angles.tolist(), distances.tolist()
+        number = max(1, 20000 // size)
+        loop = min(timeit.repeat(lambda: transform_points(angles_list, distances_list, bounds, (0, 0), 5, 4, False, table_lists),
+                                 number=number, repeat=repeat)) / number
+        vectorized = min(timeit.repeat(lambda: transform_revolution(angles, distances, bounds, (0, 0), 5, 4, False, table),
+                                       number=number, repeat=repeat)) / number
+        print('{:>6} {:>12.3f} {:>12.3f} {:>8.1f}'.format(size, loop * 1000, vectorized * 1000, loop / vectorized))
+
+
+class Crowd:
+    # visitors walking straight at a constant speed and bouncing off the walls of the area
+    def __init__(self, visitors, area, speed=1300, seed=0):
+        rng = np.random.default_rng(seed)
+        (x0, y0), (x1, y1) = area
+        self.low = np.array([x0, y0], float)
+        self.size = np.array([x1 - x0, y1 - y0], float)
+        self.start = rng.uniform(0, 1, (visitors, 2)) * self.size
+        heading = rng.uniform(0, 2 * np.pi, visitors)
+        self.velocity = np.column_stack((np.cos(heading), np.sin(heading))) * speed
+
+    def positions(self, t):
+        folded = np.mod(self.start + self.velocity * t, 2 * self.size)
+        return self.low + np.where(folded > self.size, 2 * self.size - folded, folded)
+
+
+def scan(origin, angles, centers, room, radius=200):
+    radians = np.radians(-angles)
+    u = np.column_stack((np.cos(radians), np.sin(radians)))
+    (x0, y0), (x1, y1) = room
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tx = np.where(u[:, 0] > 0, x1 - origin[0], x0 - origin[0]) / u[:, 0]
+        ty = np.where(u[:, 1] > 0, y1 - origin[1], y0 - origin[1]) / u[:, 1]
+    distances = np.minimum(np.abs(tx), np.abs(ty))
+    if len(centers):
+        w = centers - np.asarray(origin)
+        projection = u @ w.T
+        perpendicular = (w ** 2).sum(1) - projection ** 2
+        hit = (projection > 0) & (perpendicular < radius ** 2)
+        depth = np.sqrt(np.maximum(radius ** 2 - perpendicular, 0))
+        distances = np.minimum(distances, np.where(hit, projection - depth, np.inf).min(1))
+    return np.maximum(distances, 0)
+
+
+def write_recordings(directory, crowd, origins, room, duration, samples=2000, rate=5.5):
+    per_revolution = int(samples / rate)
+    angles = np.arange(per_revolution) * 360 / per_revolution
+    revolutions = int(duration * rate)
+    paths = []
+    for k, origin in enumerate(origins):
+        records = np.zeros(revolutions * per_revolution, RECORD)
+        for r in range(revolutions):
+            block = records[r * per_revolution:(r + 1) * per_revolution]
+            block['t'] = (r * per_revolution + np.arange(per_revolution)) / samples
+            block['new_scan'][0] = 1
+            block['quality'] = 15
+            block['angle'] = angles
+            block['distance'] = scan(origin, angles, crowd.positions(block['t'][per_revolution // 2]), room)
+        serial_number = 'SIM{}'.format(k)
+        path = os.path.join(directory, serial_number + SUFFIX)
+        recorder = Recorder(path, 'synthetic', serial_number)
+        recorder.extend(records)
+        recorder.close()
+        paths.append(path)
+    return paths
+
+
+def cell_entries(crowd, grid, duration, step=0.01):
+    t = np.arange(0, duration, step)
+    positions = crowd.positions(t[:, None, None])
+    j = np.floor((positions[..., 0] - grid.x0) / (grid.h + 1)).astype(int)
+    i = np.floor((positions[..., 1] - grid.y0) / (grid.h + 1)).astype(int)
+    cell = np.where((0 <= i) & (i < grid.height) & (0 <= j) & (j < grid.width), i * grid.width + j, -1)
+    entered = (cell[1:] != cell[:-1]) & (cell[1:] >= 0)
+    steps, visitors = np.nonzero(entered)
+    cells = cell[1:][steps, visitors]
+    return list(zip(t[1:][steps].tolist(), (cells // grid.width).tolist(), (cells % grid.width).tolist()))
+
+
+def start_server(grid, port, bus_delay):
+    # plain Modbus TCP slaves stand in for the RS-485 controllers behind the RTU over TCP gateway
+    server = modbus_tcp.TcpServer(port=port, address='127.0.0.1')
+    writes = []
+    slaves = {}
+    for rs_num in np.unique(grid.rs_num[grid.rs_num > 0]).tolist():
+        slave = server.add_slave(rs_num)
+        slave.add_block('showers', cst.HOLDING_REGISTERS, 0, int(grid.led_num.max()) + 2)
+        slaves[id(slave)] = rs_num
+
+    def on_request(args):
+        if bus_delay:
+            time.sleep(bus_delay)
+
+    def on_single(args):
+        slave, pdu = args
+        _, register, value = struct.unpack('>BHH', pdu[:5])
+        writes.append((time.time(), slaves[id(slave)], register, value))
+
+    def on_multiple(args):
+        slave, pdu = args
+        _, start, count, _ = struct.unpack('>BHHB', pdu[:6])
+        values = struct.unpack('>' + 'H' * count, pdu[6:6 + 2 * count])
+        now = time.time()
+        writes.extend((now, slaves[id(slave)], register, value) for register, value in enumerate(values, start))
+
+    server_hooks = [('modbus.Server.before_handle_request', on_request),
+                    ('modbus.Slave.handle_write_single_register_request', on_single),
+                    ('modbus.Slave.handle_write_multiple_registers_request', on_multiple)]
+    for name, hook in server_hooks:
+        hooks.install_hook(name, hook)
+    server.start()
+    return server, server_hooks, writes
+
+
+def latencies(entries, writes, grid, epoch, speed, warmup):
+    history = {}
+    for t, rs_num, register, value in writes:
+        history.setdefault((rs_num, register), []).append((t, value))
+    result = []
+    for t, i, j in entries:
+        if not grid.rs_num[i, j] or t < warmup:
+            continue
+        wall = epoch + t / (speed or 1)
+        before = [value for write_time, value in history.get((int(grid.rs_num[i, j]), int(grid.led_num[i, j]) + 1), [])
+                  if write_time < wall]
+        if before and before[-1] == OFF:
+            continue
+        after = [write_time for write_time, value in history.get((int(grid.rs_num[i, j]), int(grid.led_num[i, j]) + 1), [])
+                 if write_time >= wall and value == OFF]
+        if after:
+            result.append(after[0] - wall)
+    return np.array(result)
+
+
+def bench_pipeline(lidars, visitors, height, width, duration, speed=1.0, tick_rate=30, bus_delay=0.005,
+                   port=15020, warmup=1.0, tracking=True):
+    settings = {'x': 0, 'y': 0, 'grid': {'height': height, 'width': width, 'h': 600}}
+    grid = Grid(settings)
+    room = ((grid.x0 - 1000, grid.y0 - 1000), (grid.x1 + 1000, grid.y1 + 1000))
+    mid_x, mid_y = (grid.x0 + grid.x1) // 2, (grid.y0 + grid.y1) // 2
+    places = [(grid.x0 - 300, grid.y0 - 300), (grid.x1 + 300, grid.y1 + 300), (grid.x0 - 300, grid.y1 + 300),
+              (grid.x1 + 300, grid.y0 - 300), (mid_x, grid.y0 - 300), (mid_x, grid.y1 + 300),
+              (grid.x0 - 300, mid_y), (grid.x1 + 300, mid_y)]
+    origins = [places[k % len(places)] for k in range(lidars)]
+    crowd = Crowd(visitors, ((grid.x0, grid.y0), (grid.x1, grid.y1)))
+    directory = tempfile.mkdtemp()
+    paths = write_recordings(directory, crowd, origins, room, duration)
+    for k, origin in enumerate(origins):
+        settings['SIM{}'.format(k)] = False, origin[0], origin[1]
+    server, server_hooks, writes = start_server(grid, port, bus_delay)
+    dispatcher = Dispatcher(modbus_tcp.TcpMaster('127.0.0.1', port, timeout_in_sec=0.5))
+    dispatcher.start()
+    workers = [Lidar(grid, settings, path, replay_speed=speed) for path in paths]
+    engine = Engine(grid, workers, dispatcher, tick_rate, tracker=Tracker() if tracking else None)
+    epoch = time.time() + 2.0
+    for worker in workers:
+        worker.replay_start = epoch
+        worker.is_all_points = True
+        worker.start()
+    grid.activate()
+    end = epoch + duration / (speed or 1)
+    ticks = []
+    deadline = time.time()
+    while deadline < end:
+        start = time.perf_counter()
+        engine.tick()
+        if deadline >= epoch + warmup:
+            ticks.append(time.perf_counter() - start)
+        deadline += engine.period
+        time.sleep(max(0, deadline - time.time()))
+    points = sum(int(worker.channel.head[0]) for worker in workers)
+    errors = sum(event == 'error' for event, _ in dispatcher.poll())
+    for worker in workers:
+        worker.stop()
+        worker.close()
+    dispatcher.stop()
+    server.stop()
+    for name, hook in server_hooks:
+        hooks.uninstall_hook(name, hook)
+    shutil.rmtree(directory)
+    latency = latencies(cell_entries(crowd, grid, duration), writes, grid, epoch, speed, warmup)
+    grid.close()
+    ticks = np.array(ticks)
+    return {
+        'points/s': points / (end - epoch),
+        'tick ms': ticks.mean() * 1000,
+        'tick p99 ms': np.percentile(ticks, 99) * 1000,
+        'writes': len(writes),
+        'errors': errors,
+        'latency p50 ms': np.percentile(latency, 50) * 1000 if len(latency) else np.nan,
+        'latency p90 ms': np.percentile(latency, 90) * 1000 if len(latency) else np.nan,
+        'latency p99 ms': np.percentile(latency, 99) * 1000 if len(latency) else np.nan,
+    }
+
+
+def bench_scaling(lidars, visitors, grids, duration, speed, bus_delay, tracking):
+    columns = None
+    for size in grids:
+        height, width = map(int, size.split('x'))
+        for lidar_count in lidars:
+            for visitor_count in visitors:
+                result = bench_pipeline(lidar_count, visitor_count, height, width, duration, speed,
+                                        bus_delay=bus_delay, tracking=tracking)
+                if columns is None:
+                    columns = list(result)
+                    print('{:>6} {:>8} {:>6} '.format('lidars', 'visitors', 'cells') +
+                          ' '.join('{:>14}'.format(column) for column in columns))
+                print('{:>6} {:>8} {:>6} '.format(lidar_count, visitor_count, height * width) +
+                      ' '.join('{:>14.1f}'.format(result[column]) for column in columns))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('suite', nargs='?', default='transform', choices=('transform', 'pipeline'))
+    parser.add_argument('--lidars', nargs='+', type=int, default=[1, 4])
+    parser.add_argument('--visitors', nargs='+', type=int, default=[5, 20])
+    parser.add_argument('--grid', nargs='+', default=['4x5', '10x10'], help='grid sizes as HEIGHTxWIDTH')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of synthetic recording per run')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 replays as fast as possible')
+    parser.add_argument('--bus-delay', type=float, default=0.005, help='simulated RS-485 time per transaction')
+    parser.add_argument('--no-tracking', dest='tracking', action='store_false', help='yellow ring instead of prediction')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.suite == 'transform':
+        bench_transform()
+    else:
+        bench_scaling(args.lidars, args.visitors, args.grid, args.duration, args.speed, args.bus_delay, args.tracking)
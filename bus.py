@@ -0,0 +1,251 @@
+import time
+import queue
+import threading
+import modbus_tk.defines as cst
+from modbus_tk.exceptions import ModbusInvalidResponseError
+
+ON = 255
+OFF = 0
+
+
+class WritePlanner:
+    def __init__(self, metrics=None):
+        self.shadow = {}  # rs_num -> {register: last value written}
+        self.metrics = metrics
+
+    def value(self, rs_num, register):
+        return self.shadow.get(rs_num, {}).get(register)
+
+    def plan(self, targets, forced=()):
+        pending = {}
+        for rs_num, register, value in targets:
+            if (rs_num, register) in forced or self.value(rs_num, register) != value:
+                pending.setdefault(rs_num, {})[register] = value
+        batches = []
+        for rs_num, registers in sorted(pending.items()):
+            start = values = None
+            for register in sorted(registers):
+                if values is not None and register == start + len(values):
+                    values.append(registers[register])
+                    continue
+                if values is not None:
+                    batches.append((rs_num, start, values))
+                start, values = register, [registers[register]]
+            batches.append((rs_num, start, values))
+        return batches
+
+    def execute(self, master, batches):
+        for rs_num, start, values in batches:
+            transaction_start = time.perf_counter()
+            if len(values) == 1:
+                master.execute(rs_num, cst.WRITE_SINGLE_REGISTER, start, output_value=values[0])
+            else:
+                master.execute(rs_num, cst.WRITE_MULTIPLE_REGISTERS, start, output_value=values)
+            if self.metrics:
+                self.metrics.observe('modbus {}'.format(rs_num), time.perf_counter() - transaction_start)
+            registers = self.shadow.setdefault(rs_num, {})
+            for register, value in enumerate(values, start):
+                registers[register] = value
+
+    def read(self, master, rs_num):
+        # registers of one controller whose value differs from the shadow, read back in one request
+        registers = self.shadow.get(rs_num)
+        if not registers:
+            return []
+        start = min(registers)
+        values = master.execute(rs_num, cst.READ_HOLDING_REGISTERS, start, max(registers) - start + 1)
+        return [(rs_num, register, value) for register, value in sorted(registers.items())
+                if values[register - start] != value]
+
+    def reconcile(self, master, rs_num):
+        targets = self.read(master, rs_num)
+        self.execute(master, self.plan(targets, {(rs_num, register) for rs_num, register, _ in targets}))
+        return len(targets)
+
+    def write(self, master, targets, force=False):
+        targets = list(targets)
+        self.execute(master, self.plan(targets, {(rs_num, register) for rs_num, register, _ in targets}
+                                       if force else ()))
+
+
+class Breaker:
+    # per controller: after threshold failures in a row its transactions are skipped, then one probe is let
+    # through after a backoff that doubles with every failed probe
+    def __init__(self, threshold=3, backoff=1.0, max_backoff=30.0):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = {}
+        self.open_until = {}
+
+    def allows(self, rs_num, now):
+        return now >= self.open_until.get(rs_num, 0)
+
+    def success(self, rs_num):
+        # True if the controller was degraded
+        self.failures.pop(rs_num, None)
+        return self.open_until.pop(rs_num, None) is not None
+
+    def failure(self, rs_num, now):
+        # True if the controller has just become degraded
+        failures = self.failures.get(rs_num, 0) + 1
+        self.failures[rs_num] = failures
+        if failures < self.threshold:
+            return False
+        is_new = rs_num not in self.open_until
+        self.open_until[rs_num] = now + min(self.backoff * 2 ** (failures - self.threshold), self.max_backoff)
+        return is_new
+
+    @property
+    def degraded(self):
+        return sorted(self.open_until)
+
+
+class Dispatcher(threading.Thread):
+    # owns the modbus master; pending writes are keyed by register, so a newer state replaces an unsent one.
+    # With reconcile_interval, one controller at a time is read back while the bus is idle and lost writes resent
+    def __init__(self, master, planner=None, reconcile_interval=None, quiet=0.1, breaker=None):
+        super().__init__(daemon=True)
+        self.master = master
+        self.planner = planner or WritePlanner()
+        self.breaker = breaker or Breaker()
+        self.reconcile_interval = reconcile_interval
+        self.quiet = quiet  # seconds without writes before a read back
+        self._last_write = 0
+        self._next_reconcile = time.monotonic() + (reconcile_interval or 0)
+        self._reconcile_index = 0
+        self.events = queue.Queue()
+        self._pending = {}
+        self._forced = set()
+        self._batches = []  # precompiled batches, written as they are
+        self._deferred = {}  # writes to degraded controllers, sent with their next probe
+        self._condition = threading.Condition()
+        self._running = True
+        self.runtime = 0  # seconds taken by the last pass that wrote batches
+
+    def submit(self, targets, force=False):
+        with self._condition:
+            for rs_num, register, value in targets:
+                self._pending[rs_num, register] = value
+                if force:
+                    self._forced.add((rs_num, register))
+                else:
+                    self._forced.discard((rs_num, register))
+            self._condition.notify()
+
+    def submit_batches(self, batches):
+        with self._condition:
+            self._batches.extend(batches)
+            self._condition.notify()
+
+    def poll(self):
+        events = []
+        while not self.events.empty():
+            events.append(self.events.get_nowait())
+        return events
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self.join()
+
+    def _reconcile_time(self):
+        return max(self._next_reconcile, self._last_write + self.quiet) if self.reconcile_interval else None
+
+    def _wait(self):
+        while self._running and not self._pending and not self._batches:
+            wakeups = [self.breaker.open_until.get(rs_num, 0) for rs_num, _ in self._deferred]
+            if self.reconcile_interval:
+                wakeups.append(self._reconcile_time())
+            if not wakeups:
+                self._condition.wait()
+                continue
+            timeout = min(wakeups) - time.monotonic()
+            if timeout <= 0:
+                return
+            self._condition.wait(timeout)
+
+    def _take_deferred(self):
+        now = time.monotonic()
+        due = {key: value for key, value in self._deferred.items() if self.breaker.allows(key[0], now)}
+        for key in due:
+            del self._deferred[key]
+        return due
+
+    def reconcile(self):
+        controllers = sorted(self.planner.shadow)
+        self._next_reconcile = time.monotonic() + self.reconcile_interval
+        if not controllers:
+            return
+        rs_num = controllers[self._reconcile_index % len(controllers)]
+        self._reconcile_index += 1
+        if not self.breaker.allows(rs_num, time.monotonic()):
+            return
+        try:
+            fixed = self.planner.reconcile(self.master, rs_num)
+        except Exception as e:
+            self._failed(rs_num, e)
+            return
+        self._succeeded(rs_num)
+        self.events.put(('reconciled', (rs_num, fixed)))
+
+    def _succeeded(self, rs_num):
+        if self.breaker.success(rs_num):
+            self.events.put(('recovered', rs_num))
+
+    def _failed(self, rs_num, error):
+        if isinstance(error, (OSError, ModbusInvalidResponseError)):
+            self.master.close()  # reopened by the next transaction, also after the adapter restarts
+        if self.breaker.failure(rs_num, time.monotonic()):
+            self.events.put(('degraded', (rs_num, error)))
+
+    def _execute(self, batches):
+        # a failing controller only delays its own batches, the others are written as usual;
+        # returns the number of batches sent on the bus
+        sent = 0
+        for batch in batches:
+            rs_num, start, values = batch
+            if self.breaker.allows(rs_num, time.monotonic()):
+                sent += 1
+                try:
+                    self.planner.execute(self.master, [batch])
+                    self._succeeded(rs_num)
+                    continue
+                except Exception as e:
+                    self._failed(rs_num, e)
+            for register, value in enumerate(values, start):
+                self._deferred[rs_num, register] = value
+        return sent
+
+    def run(self):
+        while True:
+            with self._condition:
+                self._wait()
+                if not self._pending and not self._batches and not self._running:
+                    return
+                pending, self._pending = self._pending, {}
+                forced, self._forced = self._forced, set()
+                batches, self._batches = self._batches, []
+            due = self._take_deferred()
+            forced |= set(due)
+            pending = {**due, **pending}
+            now = time.monotonic()
+            for key in [key for key in pending if not self.breaker.allows(key[0], now)]:
+                self._deferred[key] = pending.pop(key)  # kept for the next probe instead of planned every tick
+            targets = [(rs_num, register, value) for (rs_num, register), value in pending.items()]
+            batches += self.planner.plan(targets, forced)
+            # passes that send nothing don't count as bus activity, so the bus stays quiet for read backs
+            start = time.time()
+            try:
+                sent = self._execute(batches)
+                if sent:
+                    self.runtime = time.time() - start
+                    self.events.put(('done', self.runtime))
+            except Exception as e:
+                self.events.put(('error', e))
+                sent = len(batches)
+            if sent:
+                self._last_write = time.monotonic()
+            elif self.reconcile_interval and time.monotonic() >= self._reconcile_time():
+                self.reconcile()
@@ -0,0 +1,375 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+import serial.tools.list_ports
+from grid import Grid
+from lidar import Lidar, encode_background, discover
+from bus import Dispatcher, WritePlanner, Breaker
+from engine import Engine
+from analytics import Store, Recorder
+from tracking import Tracker
+from sequencer import Sequencer, SHOWS, compile_show
+from supervisor import Supervisor
+from metrics import Metrics, Exporter, ENGINE_STAGES
+from modbus_tk import modbus_rtu_over_tcp
+
+SETTINGS = 'settings.cfg'
+GATEWAY = {'host': '192.168.0.191', 'port': 9761}
+MODES = ('interactive', 'special')
+
+
+def load_settings():
+    try:
+        with open(SETTINGS, 'r') as file:
+            return json.load(file)
+    except:
+        return {'x': 0, 'y': 0, 'sens': 0}
+
+
+@contextmanager
+def settings_lock(timeout=5.0):
+    # zone processes share settings.cfg; a lock older than timeout was left by a process that died holding it
+    path = SETTINGS + '.lock'
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.monotonic() > deadline:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                deadline = time.monotonic() + timeout
+            time.sleep(0.01)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(path)
+
+
+def save_settings(lidars, grid, zone=None, was_active=None):
+    with settings_lock():
+        file_settings = load_settings()
+        settings = file_settings.setdefault('zones', {}).setdefault(zone, {}) if zone else file_settings
+        _update_settings(settings, lidars, grid, was_active or {})
+        # readers see the old or the new file, never a partly written one
+        temp = '{}.{}.tmp'.format(SETTINGS, os.getpid())
+        with open(temp, 'w') as file:
+            json.dump(file_settings, file)
+        os.replace(temp, SETTINGS)
+
+
+def _update_settings(settings, lidars, grid, was_active):
+    ports = settings.setdefault('ports', {})
+    for lidar in lidars:
+        if lidar.hwid:
+            ports[lidar.port] = lidar.hwid, lidar.serial_number
+        is_active = was_active.get(lidar.port, lidar.is_active)
+        settings[lidar.serial_number] = is_active, lidar.x_shift, lidar.y_shift, lidar.yaw
+        background = settings.setdefault('background', {})
+        if lidar.has_background:
+            background[lidar.serial_number] = encode_background(lidar.background.ranges)
+        else:
+            background.pop(lidar.serial_number, None)
+    settings['x'] = grid.x0
+    settings['y'] = grid.y0
+    settings['sens'] = grid.sens
+
+
+def find_ports():
+    return {com.device: com.hwid for com in serial.tools.list_ports.comports() if com.device != 'COM1'}
+
+
+class Controller:
+    # runs the attraction without any GUI: lidars, grid, bus and engine; a GUI or the HTTP API calls its methods
+    def __init__(self, ports, settings=None, record=None, speed=1.0, metrics_port=None, metrics_file=None,
+                 master=None):
+        self.settings = load_settings() if settings is None else settings
+        settings = self.settings
+        self.grid = Grid(settings)
+        self.grid.sens = settings.get('sens', 0)
+        self.zone = settings.get('zone')  # name under "zones" in settings.cfg, None for a single room
+        self.master = master or modbus_rtu_over_tcp.RtuOverTcpMaster(**{**GATEWAY, **settings.get('gateway', {})},
+                                                                     timeout_in_sec=0.5)
+        self.metrics = Metrics(ENGINE_STAGES + tuple('modbus {}'.format(rs_num) for rs_num in self.grid.controllers))
+        self.dispatcher = Dispatcher(self.master, WritePlanner(self.metrics), settings.get('reconcile_interval', 0.5),
+                                     breaker=Breaker(**settings.get('breaker', {})))
+        self.dispatcher.start()
+        self.shows = {name: compile_show(self.grid, steps)
+                      for name, steps in {**SHOWS, **settings.get('shows', {})}.items()}
+        self.lidars = []
+        analytics = settings.get('analytics', {})
+        self.recorder = None
+        if analytics.get('enabled', True):
+            path = analytics.get('path', 'analytics.dat')
+            if self.zone:
+                path = '{1}.{0}{2}'.format(self.zone, *os.path.splitext(path))
+            self.recorder = Recorder(Store(path, self.grid.height, self.grid.width))
+            self.recorder.start()
+        tracking = settings.get('tracking', {})
+        tracker = Tracker(**tracking.get('filter', {})) if tracking.get('enabled', True) else None
+        self.engine = Engine(self.grid, self.lidars, self.dispatcher, settings.get('tick_rate', 30), self.metrics,
+                             tracker, tracking.get('lead', 0), self.recorder)
+        self.engine.start()
+        self.supervisor = Supervisor(self.lidars, **settings.get('supervisor', {}))
+        self.supervisor.start()
+        self.exporter = Exporter(lambda: [('main', self.metrics)] + [(lidar.port, lidar.metrics)
+                                                                      for lidar in self.lidars],
+                                 metrics_port, metrics_file)
+        self.exporter.start()
+        self.lock = threading.RLock()
+        self.state = 'UNDEFINED'
+        self.mode = None
+        self.modbus_runtime = 0
+        self.errors = 0
+        self.reconciled = 0  # registers found different on a controller and written again
+        self.degraded = set()  # controllers skipped by the circuit breaker
+        self._sequencer = None
+        self._was_active = {}  # lidar port -> is_active before the mode stopped the lidars
+        self._stopped = threading.Event()
+        self._watcher = threading.Thread(target=self._watch, daemon=True)
+        self._watcher.start()
+        self.missing = []
+        self._discover(ports if isinstance(ports, dict) else dict.fromkeys(ports), record, speed)
+
+    def _discover(self, ports, record, speed):
+        # the engine already runs, every lidar joins it as soon as its port answers
+        cache = self.settings.get('ports', {})
+        for port, serial_number, hwid in discover(ports, cache, speed):
+            if serial_number is None:
+                self.missing.append(port)
+                continue
+            lidar = Lidar(self.grid, self.settings, port, record, speed, serial_number, hwid)
+            with self.engine.lock:
+                self.lidars.append(lidar)
+                self.lidars.sort(key=lambda lidar: lidar.port)
+        if any(list(cache.get(lidar.port, ())) != [lidar.hwid, lidar.serial_number]
+               for lidar in self.lidars if lidar.hwid):
+            self.save()
+
+    def _watch(self, period=0.1):
+        while not self._stopped.wait(period):
+            for event, value in self.dispatcher.poll():
+                if event == 'done':
+                    self.modbus_runtime = value
+                    self.grid.sync(self.dispatcher.planner)
+                elif event == 'error':
+                    self.grid.deactivate()
+                    self.state = 'UNDEFINED'
+                    self.errors += 1
+                elif event == 'degraded':
+                    self.degraded.add(value[0])
+                    self.errors += 1
+                elif event == 'recovered':
+                    self.degraded.discard(value)
+                elif event == 'reconciled':
+                    self.reconciled += value[1]
+                    self.grid.sync(self.dispatcher.planner)
+
+    def status(self):
+        grid = self.grid
+        return {
+            'state': self.state,
+            'mode': self.mode,
+            'tick_time': self.engine.tick_time,
+            'missed': self.engine.missed,
+            'modbus_runtime': self.modbus_runtime,
+            'errors': self.errors,
+            'missing': self.missing,
+            'reconciled': self.reconciled,
+            'degraded': sorted(self.degraded),
+            'sens': grid.sens,
+            'x0': grid.x0,
+            'y0': grid.y0,
+            'lidars': [{
+                'port': lidar.port,
+                'serial_number': lidar.serial_number,
+                'is_active': lidar.is_active,
+                'buffer': lidar.buffer,
+                'runtime': lidar.runtime,
+                'x_shift': lidar.x_shift,
+                'y_shift': lidar.y_shift,
+                'yaw': lidar.yaw,
+                'restarts': lidar.restarts,
+            } for lidar in self.lidars],
+        }
+
+    def frame(self):
+        # cell states, shower outputs and the last revolution of every lidar
+        states = self.grid.get_states() if self.mode else self.engine.states
+        return states, self.grid.is_on.copy(), [lidar.scans for lidar in self.lidars]
+
+    def analytics(self, level='hour', since=24):
+        # occupancy, shower on time and valve toggles of every cell over the last hours, toggles per controller
+        if not self.recorder:
+            raise ValueError('analytics are off')
+        end = time.time()
+        result = self.recorder.store.query(level, end - since * 3600, end)
+        cells = self.grid._cells
+        toggles = result['toggles']
+        return {
+            'samples': result['samples'],
+            'occupied': result['occupied'].tolist(),
+            'on': result['on'].tolist(),
+            'toggles': toggles.tolist(),
+            'controllers': {rs_num: int(toggles[cells][self.grid.rs_num[cells] == rs_num].sum())
+                            for rs_num in self.grid.controllers},
+        }
+
+    def observe(self, stage, seconds):
+        self.metrics.observe(stage, seconds)
+
+    def save(self):
+        save_settings(self.lidars, self.grid, self.zone, self._was_active if self.mode else None)
+
+    def activate(self):
+        with self.lock:
+            if not self.mode:
+                self.grid.activate()
+                self.state = 'ACTIVE'
+
+    def on_all(self):
+        with self.lock, self.engine.lock:
+            if not self.mode:
+                self.grid.deactivate()
+                self.grid.on_all(self.dispatcher)
+                self.state = 'ON ALL'
+
+    def off_all(self):
+        with self.lock, self.engine.lock:
+            if not self.mode:
+                self.grid.deactivate()
+                self.grid.off_all(self.dispatcher)
+                self.state = 'OFF ALL'
+
+    def set_sens(self, sens):
+        self.grid.sens = sens
+        self.save()
+
+    def set_origin(self, x0=None, y0=None):
+        grid = self.grid
+        with self.engine.lock:
+            if x0 is not None:
+                grid.x0 = x0
+                grid.x1 = grid.x0 + grid.width * (grid.h + 1)
+            if y0 is not None:
+                grid.y0 = y0
+                grid.y1 = grid.y0 + grid.height * (grid.h + 1)
+        self.save()
+
+    def set_all_points(self, is_all_points):
+        for lidar in self.lidars:
+            lidar.is_all_points = is_all_points
+
+    def set_lidar(self, i, is_active=None, x_shift=None, y_shift=None, yaw=None):
+        lidar = self.lidars[i]
+        with self.lock:
+            if is_active is not None and is_active != lidar.is_active and not self.mode:
+                if is_active:
+                    lidar.start()
+                else:
+                    lidar.stop()
+        if x_shift is not None:
+            lidar.x_shift = x_shift
+        if y_shift is not None:
+            lidar.y_shift = y_shift
+        if yaw is not None:
+            lidar.yaw = yaw
+        self.save()
+
+    def learn_background(self, is_learning):
+        # a stopped lidar sees nothing and keeps its background
+        for lidar in self.lidars:
+            if is_learning:
+                if lidar.is_active:
+                    lidar.learn_background()
+            else:
+                lidar.keep_background()
+        if not is_learning:
+            self.save()
+
+    def align(self, wait=1.0):
+        # every active lidar is fitted onto the first one, a revolution with all points is needed from each
+        active = [lidar for lidar in self.lidars if lidar.is_active]
+        is_all_points = [lidar.is_all_points for lidar in active]
+        for lidar in active:
+            lidar.is_all_points = True
+        time.sleep(wait)
+        for lidar in active[1:]:
+            lidar.align_to(active[0])
+        for lidar, flag in zip(active, is_all_points):
+            lidar.is_all_points = flag
+        self.save()
+
+    def switch(self, x, y):
+        if self.mode == 'interactive':
+            self.grid.switch(self.dispatcher, x, y)
+
+    def set_mode(self, mode=None, show='special'):
+        # interactive and special modes pause the engine and the lidars until the mode is left;
+        # special mode plays a show from settings 'shows' or SHOWS
+        with self.lock:
+            if mode == self.mode:
+                return
+            self._leave_mode()
+            if mode not in MODES:
+                return
+            if mode == 'special' and show not in self.shows:
+                raise ValueError('unknown show {}'.format(show))
+            self.engine.pause()
+            self.grid.deactivate()
+            self.grid.reset_state()
+            self._was_active = {lidar.port: lidar.is_active for lidar in self.lidars}
+            for lidar in self.lidars:
+                if lidar.is_active:
+                    lidar.stop()
+            if mode == 'interactive':
+                self.grid.off_all(self.dispatcher)
+                self.state = 'INTERACTIVE'
+            else:
+                self.state = 'SPECIAL'
+                self._sequencer = Sequencer(self.grid, self.dispatcher, self.shows[show])
+                self._sequencer.start()
+            self.mode = mode
+
+    def _leave_mode(self):
+        if not self.mode:
+            return
+        if self._sequencer:
+            self._sequencer.stop()
+            self._sequencer = None
+        self.grid.off_all(self.dispatcher)
+        self.state = 'OFF ALL'
+        if self.mode == 'special':
+            self.grid.set_prev_state()
+        for lidar in self.lidars:
+            if self._was_active.get(lidar.port):
+                lidar.start()
+        self.mode = None
+        self.engine.resume()
+
+    def close(self):
+        with self.lock:
+            if self._sequencer:
+                self._sequencer.stop()
+            if self.mode:
+                self.grid.off_all(self.dispatcher)
+            self._stopped.set()
+            self.supervisor.stop()
+            self.exporter.stop()
+            self.engine.stop()
+            if self.recorder:
+                self.recorder.stop()
+                self.recorder.store.close()
+            for lidar in self.lidars:
+                if lidar.is_active:
+                    lidar.stop()
+                lidar.close()
+            self.grid.close()
+            self.dispatcher.stop()
+            self.metrics.close()
@@ -0,0 +1,38 @@
+#!/usr/bin/python
+import signal
+import argparse
+import threading
+from controller import find_ports
+from zones import Site
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='runs the rain room without a GUI')
+    parser.add_argument('--replay', nargs='+', metavar='FILE', help='lidar recordings to use instead of COM ports')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 replays as fast as possible')
+    parser.add_argument('--record', metavar='DIR', help='record raw lidar measurements to DIR')
+    parser.add_argument('--metrics-port', type=int, help='serve stage latency metrics on this local port')
+    parser.add_argument('--metrics-file', help='rewrite stage latency metrics to this file every few seconds')
+    parser.add_argument('--api-port', type=int, default=8765, help='local port of the control API, zones count up')
+    parser.add_argument('--activate', action='store_true', help='activate the showers at start')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    site = Site(args.replay or find_ports(), record=args.record, speed=args.speed, api_port=args.api_port,
+                metrics_port=args.metrics_port, metrics_file=args.metrics_file)
+    if args.activate:
+        for zone in site.zones.values():
+            zone.activate()
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    site.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import time
+import threading
+import numpy as np
+from grid import State
+
+
+class Engine(threading.Thread):
+    # runs occupancy and shower control at a fixed tick rate; the GUI only reads the published snapshot
+    def __init__(self, grid, lidars, dispatcher, rate=30, metrics=None, tracker=None, lead=0, recorder=None):
+        super().__init__(daemon=True)
+        self.grid = grid
+        self.lidars = lidars
+        self.dispatcher = dispatcher
+        self.metrics = metrics
+        self.tracker = tracker
+        self.lead = lead  # seconds predicted beyond the measured latency
+        self.recorder = recorder
+        self.period = 1 / rate
+        self.lock = threading.Lock()
+        self.paused = False
+        self.states = grid.get_states()
+        self.tick_time = 0
+        self.ticks = 0
+        self.missed = 0
+        self._stopped = threading.Event()
+
+    def pause(self):
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    @property
+    def latency(self):
+        # age of the oldest lidar grid in use, a tick and the duration of the last write that reached the bus
+        ages = self.grid.ages[self.grid.weights > 0]
+        return (ages.max() if len(ages) else 0) + self.period + self.dispatcher.runtime
+
+    def _points(self):
+        scans = [lidar.scans for lidar, weight in zip(self.lidars, self.grid.weights) if weight > 0]
+        return np.concatenate(scans) if scans else np.zeros((0, 2))
+
+    def tick(self):
+        start = time.monotonic()
+        with self.lock:
+            if self.paused:
+                return
+            self.grid.reset_state()
+            self.grid.fuse(self.lidars)
+            fused = time.monotonic()
+            predicted = None
+            if self.tracker:
+                self.tracker.update(self._points(), fused)
+                predicted = self.tracker.cells(self.grid, self.latency + self.lead)
+            tracked = time.monotonic()
+            self.grid.classify(tracked, predicted)
+            classified = time.monotonic()
+            self.grid.update_showers(self.dispatcher)
+            self.states = self.grid.get_states()
+            if self.recorder:
+                self.recorder.sample(time.time(), self.states == State.GREEN, self.grid.is_on)
+        self.tick_time = time.monotonic() - start
+        self.ticks += 1
+        if self.metrics:
+            self.metrics.observe('fusion', fused - start)
+            self.metrics.observe('tracking', tracked - fused)
+            self.metrics.observe('state update', classified - tracked)
+            self.metrics.observe('tick', self.tick_time)
+
+    def run(self):
+        deadline = time.monotonic()
+        while not self._stopped.is_set():
+            self.tick()
+            deadline += self.period
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                self.missed += 1 + int(-delay / self.period)
+                deadline = time.monotonic()
+            else:
+                self._stopped.wait(delay)
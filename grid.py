@@ -1,106 +1,132 @@
-import modbus_tk.defines as cst
-import PySimpleGUI as sg
 import time
-import multiprocessing
-from enum import Enum, auto
+import numpy as np
+from enum import Enum, IntEnum, auto
+from shm import SharedConfig
+from bus import ON, OFF
 
 
-class State(Enum):
+class State(IntEnum):
     CLEAR = auto()
     GREEN = auto()
     YELLOW = auto()
-3
+
 
 class Mode(Enum):
     ON = auto()
     OFF = auto()
 
 
-class Shower:
-    def __init__(self):
-        self.rs_num = None
-        self.led_num = None
-        self.is_on = False
-        self.is_off = True
-        self.state = State.CLEAR
-        self.point_count = 0
+DEFAULT_GEOMETRY = {'height': 4, 'width': 5, 'h': 600, 'thresholds': [[3, 0, None], [3, 2, 5]]}
+MIN_SCORE = 0.5  # a decayed score below half a point is an empty cell
 
-    def on(self, master):
-        master.execute(self.rs_num, cst.WRITE_SINGLE_REGISTER, self.led_num + 1, output_value=255)
-        self.is_on = True
-        self.is_off = False
 
-    def off(self, master):
-        master.execute(self.rs_num, cst.WRITE_SINGLE_REGISTER, self.led_num + 1, output_value=0)
-        self.is_on = False
-        self.is_off = True
+def default_showers(height, width):
+    showers = []
+    rs_i = 1
+    led_i = 0
+    for i in range(height - 1, -1, -1):
+        for j in range(1, width):
+            if led_i > 5:
+                rs_i += 1
+                led_i = 0
+            showers.append([i, j, rs_i, led_i])
+            led_i += 1
+    return showers
 
 
 class Grid:
     def __init__(self, settings):
-        manager = multiprocessing.Manager()
-        self._x0 = manager.Value('i', 0 if not settings else settings['x'])
-        self._y0 = manager.Value('i', 0 if not settings else settings['y'])
-        self._h = manager.Value('i', 600)
-        self.height = 4
-        self.width = 5
-        self._x1 = manager.Value('i', self.x0 + self.width * (self.h + 1))
-        self._y1 = manager.Value('i', self.y0 + self.height * (self.h + 1))
+        settings = settings or {}
+        geometry = settings.get('grid', DEFAULT_GEOMETRY)
+        self.height = geometry['height']
+        self.width = geometry['width']
+        x0 = settings.get('x', 0)
+        y0 = settings.get('y', 0)
+        h = geometry['h']
+        self.config = SharedConfig(('x0', 'y0', 'x1', 'y1', 'h'), {
+            'x0': x0,
+            'y0': y0,
+            'x1': x0 + self.width * (h + 1),
+            'y1': y0 + self.height * (h + 1),
+            'h': h,
+        })
         self.is_active_prev = False
         self.is_active = False
         self.last_static_mode = False
         self.sens = 0
-        rs_i = 1
-        led_i = 0
-        self.showers = [[Shower() for _ in range(self.width)] for _ in range(self.height)]
-        for i in range(self.height - 1, -1, -1):
-            for j in range(1, self.width):
-                if led_i > 5:
-                    rs_i += 1
-                    led_i = 0
-                self.showers[i][j].rs_num = rs_i
-                self.showers[i][j].led_num = led_i
-                led_i += 1
+        fusion = settings.get('fusion', {})
+        self.fresh_age = fusion.get('fresh', 0.25)  # seconds a lidar grid counts in full
+        self.stale_age = fusion.get('stale', 1.0)  # seconds after which it is dropped
+        self.ages = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.revolutions = []
+        occupancy = settings.get('occupancy', {})
+        self.half_life = occupancy.get('half_life', 0.3)  # seconds for the score of a left cell to halve
+        self.hysteresis = occupancy.get('hysteresis', 0.5)  # points below the threshold to release a cell
+        self.min_dwell = occupancy.get('dwell', 1.0)  # seconds a cell stays green before it may be released
+        shape = self.height, self.width
+        self.rs_num = np.zeros(shape, np.int32)  # 0 is a cell without a shower
+        self.led_num = np.full(shape, -1, np.int32)
+        for i, j, rs_num, led_num in geometry.get('showers') or default_showers(self.height, self.width):
+            self.rs_num[i, j] = rs_num
+            self.led_num[i, j] = led_num
+        self.thresholds = np.full(shape, np.nan)  # nan follows sens, inf never turns green
+        for i, j, threshold in geometry.get('thresholds', []):
+            self.thresholds[i, j] = np.inf if threshold is None else threshold
+        self.point_count = np.zeros(shape)
+        self.state = np.full(shape, State.CLEAR, np.uint8)
+        self.is_on = np.zeros(shape, bool)
+        self.score = np.zeros(shape)
+        self.is_green = np.zeros(shape, bool)
+        self.changed_at = np.zeros(shape)
+        self._scored_at = None
+        self._cells = np.nonzero(self.rs_num)
+        self.controllers = np.unique(self.rs_num[self._cells]).tolist()
+        self._rs_nums = self.rs_num[self._cells].tolist()
+        self._registers = (self.led_num[self._cells] + 1).tolist()
 
     @property
     def x0(self):
-        return self._x0.value
+        return int(self.config['x0'])
 
     @x0.setter
     def x0(self, x0):
-        self._x0.value = x0
+        self.config['x0'] = x0
 
     @property
     def y0(self):
-        return self._y0.value
+        return int(self.config['y0'])
 
     @y0.setter
     def y0(self, y0):
-        self._y0.value = y0
+        self.config['y0'] = y0
 
     @property
     def x1(self):
-        return self._x1.value
+        return int(self.config['x1'])
 
     @x1.setter
     def x1(self, x1):
-        self._x1.value = x1
+        self.config['x1'] = x1
 
     @property
     def y1(self):
-        return self._y1.value
+        return int(self.config['y1'])
 
     @y1.setter
     def y1(self, y1):
-        self._y1.value = y1
+        self.config['y1'] = y1
 
     @property
     def h(self):
-        return self._h.value
+        return int(self.config['h'])
 
     @h.setter
     def h(self, h):
-        self._h.value = h
+        self.config['h'] = h
+
+    def close(self):
+        self.config.close()
 
     def _print_grid(self, graph):
         for i in range(self.height + 1):
@@ -108,105 +134,89 @@ class Grid:
         for i in range(self.width + 1):
             graph.DrawLine((self.x0 + i * self.h, self.y0), (self.x0 + i * self.h, self.y0 + self.h * self.height))
 
-    def print(self, graph):
+    def _print_cell(self, graph, i, j, fill_color):
+        graph.DrawRectangle((self.x0 + j * self.h, self.y0 + i * self.h),
+                            (self.x0 + (j + 1) * self.h, self.y0 + (i + 1) * self.h),
+                            fill_color=fill_color)
+
+    def print_labels(self, graph):
+        import PySimpleGUI as sg  # drawing is for the GUI only, the controller runs without it
+        for i, j in zip(*self._cells):
+            text = str(self.rs_num[i, j]) + ' ' + str(self.led_num[i, j])
+            graph.DrawText(text, (self.x0 + j * self.h, self.y0 + i * self.h),
+                           text_location=sg.TEXT_LOCATION_BOTTOM_LEFT)
+
+    def get_states(self):
+        return self.state.copy()
+
+    def print(self, graph, states=None):
+        states = self.state if states is None else states
         self._print_grid(graph)
-        for i in range(self.height):
-            for j in range(self.width):
-                shower = self.showers[i][j]
-                if shower.state is State.GREEN:
-                    graph.DrawRectangle((self.x0 + j * self.h, self.y0 + i * self.h),
-                                        (self.x0 + (j + 1) * self.h, self.y0 + (i + 1) * self.h),
-                                        fill_color='green')
-                elif shower.state is State.YELLOW:
-                    graph.DrawRectangle((self.x0 + j * self.h, self.y0 + i * self.h),
-                                        (self.x0 + (j + 1) * self.h, self.y0 + (i + 1) * self.h),
-                                        fill_color='yellow')
-                if shower.rs_num is not None:
-                    text = str(shower.rs_num) + ' ' + str(shower.led_num)
-                    graph.DrawText(text, (self.x0 + j * self.h, self.y0 + i * self.h),
-                                   text_location=sg.TEXT_LOCATION_BOTTOM_LEFT)
+        for i, j in zip(*np.nonzero(states == State.GREEN)):
+            self._print_cell(graph, i, j, 'green')
+        for i, j in zip(*np.nonzero(states == State.YELLOW)):
+            self._print_cell(graph, i, j, 'yellow')
+        self.print_labels(graph)
 
     def print_interactive(self, graph):
         self._print_grid(graph)
-        for i in range(self.height):
-            for j in range(self.width):
-                shower = self.showers[i][j]
-                if shower.rs_num is None:
-                    continue
-                if shower.is_off:
-                    graph.DrawRectangle((self.x0 + j * self.h, self.y0 + i * self.h),
-                                        (self.x0 + (j + 1) * self.h, self.y0 + (i + 1) * self.h),
-                                        fill_color='red')
-                elif shower.is_on:
-                    graph.DrawRectangle((self.x0 + j * self.h, self.y0 + i * self.h),
-                                        (self.x0 + (j + 1) * self.h, self.y0 + (i + 1) * self.h),
-                                        fill_color='green')
-                text = str(shower.rs_num) + ' ' + str(shower.led_num)
-                graph.DrawText(text, (self.x0 + j * self.h, self.y0 + i * self.h),
-                               text_location=sg.TEXT_LOCATION_BOTTOM_LEFT)
+        for i, j in zip(*self._cells):
+            self._print_cell(graph, i, j, 'green' if self.is_on[i, j] else 'red')
+        self.print_labels(graph)
 
     def reset_state(self):
-        for line in self.showers:
-            for shower in line:
-                shower.state = State.CLEAR
-                shower.point_count = 0
-
-    def update_green_state(self):
-        for i, line in enumerate(self.showers):
-            for j, shower in enumerate(line):
-                if j == 0 and i == 3:
-                    continue
-                if i == 3 and j == 2:
-                    if shower.point_count > 5:
-                        shower.state = State.GREEN
-                    continue
-                if shower.point_count > self.sens:
-                    shower.state = State.GREEN
-
-    def update_yellow_state(self):
-        def yellow(_i, _j):
-            if 0 <= _i < self.height and 0 <= _j < self.width \
-                    and (self.showers[_i][_j].state is State.CLEAR or self.showers[_i][_j].state is State.YELLOW):
-                self.showers[_i][_j].state = State.YELLOW
-
-        for i, line in enumerate(self.showers):
-            for j, shower in enumerate(line):
-                if shower.state is State.GREEN:
-                    yellow(i - 1, j - 1)
-                    yellow(i - 1, j)
-                    yellow(i - 1, j + 1)
-                    yellow(i, j + 1)
-                    yellow(i + 1, j + 1)
-                    yellow(i + 1, j)
-                    yellow(i + 1, j - 1)
-                    yellow(i, j - 1)
+        self.state.fill(State.CLEAR)
+        self.point_count.fill(0)
+
+    def update_green_state(self, now=None):
+        # the score follows a rising count at once and decays after it; a green cell is released below
+        # the threshold minus hysteresis and not before min_dwell, so a shower switches at most twice per dwell
+        now = time.monotonic() if now is None else now
+        decay = 0
+        if self._scored_at is not None and self.half_life:
+            decay = 0.5 ** ((now - self._scored_at) / self.half_life)
+        self._scored_at = now
+        np.maximum(self.point_count, self.score * decay, out=self.score)
+        self.score[self.score < MIN_SCORE] = 0
+        thresholds = np.where(np.isnan(self.thresholds), self.sens, self.thresholds)
+        green = np.where(self.is_green, self.score > np.maximum(thresholds - self.hysteresis, 0), self.score > thresholds)
+        green |= self.is_green & (now - self.changed_at < self.min_dwell)
+        self.changed_at[green != self.is_green] = now
+        self.is_green[:] = green
+        self.state[green] = State.GREEN
+
+    def update_yellow_state(self, predicted=None):
+        green = self.state == State.GREEN
+        if predicted is not None:
+            self.state[predicted & ~green] = State.YELLOW
+            return
+        padded = np.pad(green, 1)
+        near = np.zeros_like(green)
+        for di in range(3):
+            for dj in range(3):
+                near |= padded[di:di + self.height, dj:dj + self.width]
+        self.state[near & ~green] = State.YELLOW
+
+    def sync(self, planner):
+        self.is_on[self._cells] = [planner.value(rs_num, register) == ON
+                                   for rs_num, register in zip(self._rs_nums, self._registers)]
+
+    def _submit(self, client, values, force=False):
+        client.submit(list(zip(self._rs_nums, self._registers, values)), force)
 
     def update_showers(self, client):
-        start = time.time()
         if self.is_active:
-            for line in self.showers:
-                for shower in line:
-                    if shower.rs_num is not None:
-                        if shower.state in (State.GREEN, State.YELLOW) and shower.is_on:
-                            shower.off(client)
-                        elif shower.state is State.CLEAR and shower.is_off:
-                            shower.on(client)
-        return time.time() - start
+            is_clear = self.state[self._cells] == State.CLEAR
+            self._submit(client, np.where(is_clear, ON, OFF).tolist())
 
     def on_all(self, client):
-        for line in self.showers:
-            for shower in line:
-                if shower.rs_num is not None:
-                    shower.state = State.GREEN
-                    shower.on(client)
+        self.state[self._cells] = State.GREEN
+        self._submit(client, [ON] * len(self._registers), force=True)
         self.last_static_mode = True
 
     def off_all(self, client):
-        for line in self.showers:
-            for shower in line:
-                if shower.rs_num is not None:
-                    shower.state = State.CLEAR
-                    shower.off(client)
+        self.state[self._cells] = State.CLEAR
+        self._submit(client, [OFF] * len(self._registers), force=True)
         self.last_static_mode = False
 
     def activate(self):
@@ -222,52 +232,36 @@ class Grid:
 
     def update_counts(self, x, y):
         if self.x0 <= x <= self.x1 and self.y0 <= y <= self.y1:
-            j = int((x - self.x0) / (self.h + 1))
-            i = int((y - self.y0) / (self.h + 1))
-            self.showers[i][j].point_count += 1
+            j = min(int((x - self.x0) / (self.h + 1)), self.width - 1)
+            i = min(int((y - self.y0) / (self.h + 1)), self.height - 1)
+            self.point_count[i, j] += 1
 
     def switch(self, client, x, y):
         if self.x0 < x < self.x1 and self.y0 < y < self.y1:
             j = int((x - self.x0) / (self.h + 1))
             i = int((y - self.y0) / (self.h + 1))
-            shower = self.showers[i][j]
-            if shower.rs_num is not None:
-                if shower.is_on:
-                    shower.off(client)
-                else:
-                    shower.on(client)
-
-    def start_test(self, master, window):
-        self.off_all(master)
-        graph = window['graph']
-        while True:
-            for line in self.showers:
-                for shower in line:
-                    if shower.rs_num is not None:
-                        shower.state = State.GREEN
-                        shower.on(master)
-            graph.Erase()
-            self.print(graph, False)
-            event, values = window.read(timeout=0)
-            if event == sg.WIN_CLOSED:
-                return
-            time.sleep(5)
-            for line in self.showers:
-                for shower in line:
-                    if shower.rs_num is not None:
-                        shower.state = State.CLEAR
-                        shower.off(master)
-            graph.Erase()
-            self.print(graph, False)
-            event, values = window.read(timeout=0)
-            if event == sg.WIN_CLOSED:
-                return
-            time.sleep(5)
+            if self.rs_num[i, j]:
+                client.submit([(int(self.rs_num[i, j]), int(self.led_num[i, j]) + 1,
+                                OFF if self.is_on[i, j] else ON)])
+
+    def fuse(self, lidars, now=None):
+        # a cell counts the points of the lidars that see something in it, averaged over them, so that
+        # overlapping lidars don't add up and sens means the same for any number of lidars;
+        # grids older than fresh_age fade out linearly until stale_age
+        if not lidars:
+            return
+        grids, timestamps, revolutions = zip(*[lidar.frame for lidar in lidars])
+        grids = np.array(grids)
+        self.revolutions = list(revolutions)
+        self.ages = (time.time() if now is None else now) - np.array(timestamps)
+        self.weights = np.clip((self.stale_age - self.ages) / (self.stale_age - self.fresh_age), 0, 1)
+        seen = ((grids > 0) & (self.weights > 0)[:, None, None]).sum(0)
+        self.point_count[:] = np.tensordot(self.weights, grids, 1) / np.maximum(seen, 1)
+
+    def classify(self, now=None, predicted=None):
+        self.update_green_state(now)
+        self.update_yellow_state(predicted)
 
     def update_states(self, lidars):
-        for lidar in lidars:
-            for line, simple_line in zip(self.showers, lidar.simple_grid):
-                for shower, count in zip(line, simple_line):
-                    shower.point_count += count
-        self.update_green_state()
-        self.update_yellow_state()
\ No newline at end of file
+        self.fuse(lidars)
+        self.classify()
@@ -1,41 +1,57 @@
 import PySimpleGUI as sg
 
+STATE_COLORS = {'ACTIVE': 'green', 'ON ALL': 'green', 'OFF ALL': 'red', 'INTERACTIVE': 'green', 'SPECIAL': 'green'}
 
-def get_window(lidars, grid):
+
+def get_window(status, grid, zones=(), zone=None):
     sg.theme('LightGrey1')
-    layout = [
+    layout = [[sg.Text('zone'), sg.Combo(list(zones), default_value=zone, key='-ZONE-', enable_events=True,
+                                         readonly=True)]] if zones else []
+    layout += [
         [sg.Graph(canvas_size=(600, 600), graph_bottom_left=(0, -3000), graph_top_right=(6000, 3000),
                   background_color='white', key='-GRAPH-', enable_events=True)],
-        [sg.Text('delay', key='-DELAY-', size=(10, 1))],
-        [sg.Text('UNDEFINED', key='-SHOWERS STATE-', text_color='orange', size=(10, 1))],
+        [sg.Text('delay', key='-DELAY-', size=(10, 1)), sg.Text('', key='-DEGRADED-', text_color='orange', size=(30, 1))],
+        [sg.Text(status['state'], key='-SHOWERS STATE-', text_color=STATE_COLORS.get(status['state'], 'orange'),
+                 size=(12, 1))],
         [sg.Text('x'), sg.Spin([i for i in range(-10000, 10000)], initial_value=grid.x0 // 10, key='-X-', enable_events=True),
          sg.Text('y'), sg.Spin([i for i in range(-10000, 10000)], initial_value=grid.y0 // 10, key='-Y-', enable_events=True),
-         sg.Text('sensitivity'), sg.Spin([i for i in range(0, 10)], initial_value=0, key='-SENS-', enable_events=True)],
+         sg.Text('sensitivity'), sg.Spin([i for i in range(0, 10)], initial_value=status['sens'], key='-SENS-', enable_events=True)],
         [sg.Text('Points'), sg.Radio('all', 'RADIO3', key='-ALL-', enable_events=True),
          sg.Radio('inside grid', 'RADIO3', key='-INSIDE GRID-', enable_events=True, default=True)],
     ]
-    for i, lidar in enumerate(lidars):
+    for i, lidar in enumerate(status['lidars']):
 
         layout.append(
-            [sg.Checkbox(lidar.port, key='-LIDAR CHECK-' + str(i), enable_events=True, default=lidar.is_active),
+            [sg.Checkbox(lidar['port'], key='-LIDAR CHECK-' + str(i), enable_events=True, default=lidar['is_active']),
 
              sg.ProgressBar(3000, orientation='h', size=(20, 20), key='-LIDAR BUFFER-' + str(i)),
-             sg.Text('x'), sg.Spin([i for i in range(-10000, 10000)], initial_value=lidar.x_shift // 10, key='-LIDAR X-' + str(i), enable_events=True),
-             sg.Text('y'), sg.Spin([i for i in range(-10000, 10000)], initial_value=lidar.y_shift // 10, key='-LIDAR Y-' + str(i), enable_events=True),
+             sg.Text('x'), sg.Spin([i for i in range(-10000, 10000)], initial_value=lidar['x_shift'] // 10, key='-LIDAR X-' + str(i), enable_events=True),
+             sg.Text('y'), sg.Spin([i for i in range(-10000, 10000)], initial_value=lidar['y_shift'] // 10, key='-LIDAR Y-' + str(i), enable_events=True),
+             sg.Text('yaw'), sg.Spin([i / 2 for i in range(-360, 361)], initial_value=lidar['yaw'], key='-LIDAR YAW-' + str(i), enable_events=True),
              sg.Text('0', key='-LIDAR RUNTIME-' + str(i), size=(10, 1)),],
         )
     layout += [[sg.Button('activate', key='-ACTIVATE-'), sg.Button('on all', key='-ON ALL-'),
-                sg.Button('off all', key='-OFF ALL-')],
+                sg.Button('off all', key='-OFF ALL-'), sg.Button('align', key='-ALIGN-')],
                [sg.Checkbox('interactive', key='-INTERACTIVE-', enable_events=True),
-                sg.Checkbox('special', key='-SPECIAL-', enable_events=True)]]
-    return sg.Window('Rainroom', layout, finalize=True)
+                sg.Checkbox('special', key='-SPECIAL-', enable_events=True),
+                sg.Checkbox('learn background', key='-BACKGROUND-', enable_events=True)]]
+    return sg.Window('Rainroom' + (' ' + zone if zone else ''), layout, finalize=True)
+
+
+def update_window(window, status):
+    window['-DELAY-'].update('{:.3f} {}'.format(status['tick_time'], status['missed']))  # add modbus_runtime optionally
+    window['-SHOWERS STATE-'].update(status['state'], text_color=STATE_COLORS.get(status['state'], 'orange'))
+    window['-DEGRADED-'].update('no answer: ' + ', '.join(map(str, status['degraded'])) if status['degraded'] else '')
+    for i, lidar in enumerate(status['lidars']):
+        window['-LIDAR BUFFER-' + str(i)].UpdateBar(lidar['buffer'])
+        window['-LIDAR RUNTIME-' + str(i)].update('{:.3f}'.format(lidar['runtime']))
 
 
-def update_window(window, runtime, modbus_runtime, lidars):
-    window['-DELAY-'].update('{:.3f}'.format(runtime))  # add modbus_runtime optionally
-    for i, lidar in enumerate(lidars):
-        window['-LIDAR BUFFER-' + str(i)].UpdateBar(lidar.buffer)
-        window['-LIDAR RUNTIME-' + str(i)].update('{:.3f}'.format(lidar.runtime))
+def update_poses(window, status):
+    for i, lidar in enumerate(status['lidars']):
+        window['-LIDAR X-' + str(i)].update(lidar['x_shift'] // 10)
+        window['-LIDAR Y-' + str(i)].update(lidar['y_shift'] // 10)
+        window['-LIDAR YAW-' + str(i)].update(lidar['yaw'])
 
 
 def set_window_disabled(window, disabled):
@@ -1,15 +1,179 @@
-import math
+import os
+import base64
+import numpy as np
 import time
+import threading
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 from rplidar import RPLidar  # use pip install rplidar-roboticia
 from rplidar import RPLidarException
 from datetime import datetime
-from ctypes import c_bool, c_wchar_p
+from shm import SharedArrays, LidarChannel, SharedConfig
+from metrics import Metrics, WORKER_STAGES, WORKER_GAUGES
+from replay import Recorder, ReplayLidar, is_recording, SUFFIX
 
+BACKGROUND_BINS = 720  # half a degree
+ANGLE_STEPS = 360 * 64  # the sensor reports angles in 1/64 degree
+SCAN_TYPES = {'normal': 'normal', 'express': 'express', 'boost': 'express'}  # the driver has no separate boost mode
 
-def lidar_process(scans, buffer, simple_grid, width, height, runtime, port, x0, y0, x1, y1, h,
-                  x_shift, y_shift, is_active, is_all_points, scan_type='normal', max_buf_meas=3000, min_len=5):
+
+class Revolution:
+    def __init__(self, size=8192):
+        self.angles = np.empty(size)
+        self.distances = np.empty(size)
+        self.qualities = np.empty(size, np.uint8)
+        self.size = 0
+
+    def append(self, quality, angle, distance):
+        if self.size < len(self.angles):
+            self.angles[self.size] = angle
+            self.distances[self.size] = distance
+            self.qualities[self.size] = quality
+            self.size += 1
+
+    def clear(self):
+        self.size = 0
+
+
+def trig_table(yaw):
+    # cos and sin of every reported angle for a lidar turned by yaw degrees counterclockwise
+    radians = np.radians(yaw - np.arange(ANGLE_STEPS) * (360 / ANGLE_STEPS))
+    return np.cos(radians), np.sin(radians)
+
+
+def transform_points(angles, distances, bounds, shift, width, height, is_all_points, table):
+    x0, y0, x1, y1, h = bounds
+    x_shift, y_shift = shift
+    cos, sin = table
+    points = []
+    simple_grid = [[0] * width for _ in range(height)]
+    for angle, distance in zip(angles, distances):
+        k = int(angle * (ANGLE_STEPS / 360) + 0.5) % ANGLE_STEPS
+        x = distance * cos[k] + x_shift
+        y = distance * sin[k] + y_shift
+        is_in_grid = x0 <= x <= x1 and y0 <= y <= y1
+        if is_all_points or is_in_grid:
+            points.append((x, y))
+        if is_in_grid:
+            j = min(int((x - x0) / (h + 1)), width - 1)
+            i = min(int((y - y0) / (h + 1)), height - 1)
+            simple_grid[i][j] += 1
+    return points, simple_grid
+
+
+def transform_revolution(angles, distances, bounds, shift, width, height, is_all_points, table):
+    x0, y0, x1, y1, h = bounds
+    k = (angles * (ANGLE_STEPS / 360) + 0.5).astype(np.intp) % ANGLE_STEPS
+    x = distances * table[0][k] + shift[0]
+    y = distances * table[1][k] + shift[1]
+    is_in_grid = (x0 <= x) & (x <= x1) & (y0 <= y) & (y <= y1)
+    j = np.minimum(((x[is_in_grid] - x0) / (h + 1)).astype(np.intp), width - 1)
+    i = np.minimum(((y[is_in_grid] - y0) / (h + 1)).astype(np.intp), height - 1)
+    simple_grid = np.bincount(i * width + j, minlength=width * height).reshape(height, width)
+    points = np.column_stack((x, y)) if is_all_points else np.column_stack((x[is_in_grid], y[is_in_grid]))
+    return points, simple_grid
+
+
+def encode_background(ranges):
+    # uint16 millimetres in base64, 0 is a bin without background
+    ranges = np.where(np.isfinite(ranges), np.clip(ranges, 1, 65535), 0)
+    return base64.b64encode(ranges.astype('<u2').tobytes()).decode()
+
+
+def decode_background(text):
+    ranges = np.frombuffer(base64.b64decode(text), '<u2').astype(np.float64)
+    ranges[ranges == 0] = np.inf
+    return ranges
+
+
+def _rotation(angle):
+    return np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+
+
+def _nearest(points, reference, chunk=512):
+    index = np.empty(len(points), np.intp)
+    distance = np.empty(len(points))
+    for i in range(0, len(points), chunk):
+        squared = ((points[i:i + chunk, None] - reference[None]) ** 2).sum(2)
+        index[i:i + chunk] = squared.argmin(1)
+        distance[i:i + chunk] = np.sqrt(squared[np.arange(len(squared)), index[i:i + chunk]])
+    return index, distance
+
+
+def align(points, reference, iterations=50, max_distance=300, max_points=1000):
+    # point to point ICP: rotation in degrees about the room origin and shift that move points onto reference
+    points = points[::max(1, len(points) // max_points)]
+    angle, shift = 0.0, np.zeros(2)
+    for _ in range(iterations):
+        if len(points) < 3 or len(reference) < 3:
+            break
+        index, distance = _nearest(points, reference)
+        is_close = distance < max_distance
+        if is_close.sum() < 3:
+            break
+        source, target = points[is_close], reference[index[is_close]]
+        source_center, target_center = source.mean(0), target.mean(0)
+        covariance = (source - source_center).T @ (target - target_center)
+        step = np.arctan2(covariance[0, 1] - covariance[1, 0], covariance[0, 0] + covariance[1, 1])
+        rotation = _rotation(step)
+        step_shift = target_center - rotation @ source_center
+        points = points @ rotation.T + step_shift
+        angle += step
+        shift = rotation @ shift + step_shift
+        if abs(step) < 1e-5 and np.hypot(*step_shift) < 0.5:
+            break
+    return np.degrees(angle), shift
+
+
+def open_lidar(port, replay_speed=1.0, replay_start=None, **kwargs):
+    if is_recording(port):
+        return ReplayLidar(port, replay_speed, start=replay_start, **kwargs)
+    return RPLidar(port, **kwargs)
+
+
+def identify(port, replay_speed=1.0, quick=False, attempts=3):
+    # serial number of the lidar on port or None; quick asks once without stopping a scan first
+    for attempt in range(1 if quick else attempts):
+        lidar = None
+        try:
+            lidar = open_lidar(port, replay_speed, timeout=0.5)
+            if not quick:
+                lidar.stop()
+                lidar.stop_motor()
+            info = lidar.get_info()
+            if isinstance(info, dict):  # the driver returns a message while scan data is still buffered
+                return info['serialnumber']
+        except RPLidarException:
+            pass
+        finally:
+            if lidar:
+                lidar.disconnect()
+    return None
+
+
+def discover(ports, cache=None, replay_speed=1.0):
+    # probes all ports at once and yields (port, serial number, hwid) as each one answers;
+    # a port whose USB hwid matches the cache held a lidar before and gets the quick probe first
+    cache = cache or {}
+
+    def probe(port, hwid):
+        cached = cache.get(port)
+        serial_number = None
+        if hwid and cached and cached[0] == hwid:
+            serial_number = identify(port, replay_speed, quick=True)
+        return port, serial_number or identify(port, replay_speed), hwid
+
+    if not ports:
+        return
+    with ThreadPoolExecutor(len(ports)) as pool:
+        for future in as_completed([pool.submit(probe, port, hwid) for port, hwid in ports.items()]):
+            yield future.result()
+
+
+def lidar_process(channel, grid_config, config, metrics, background, port, scan_type='normal', max_buf_meas=3000,
+                  min_len=5, batched=True, record=None, serial_number='', replay_speed=1.0, replay_start=None,
+                  background_margin=50, buffer_period=0.1):
     logger = logging.Logger('rplidar_' + port)
 
     date_time = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
@@ -18,161 +182,317 @@ def lidar_process(scans, buffer, simple_grid, width, height, runtime, port, x0,
     f_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
     logger.addHandler(f_handler)
 
-    lidar = RPLidar(port, logger=logger)
-    scans_tmp = []
-    simple_grid_tmp = [[0] * width for _ in range(height)]
-    iterator = lidar.iter_measures(scan_type, max_buf_meas)
+    lidar = open_lidar(port, replay_speed, replay_start, logger=logger)
+    recorder = None
+    if record:
+        recorder = Recorder(os.path.join(record, serial_number + '_' + date_time + SUFFIX), port, serial_number)
+    transform = transform_revolution if batched else transform_points
+    table_yaw = table = None
+    revolution = Revolution()
+    sector_size = 360 / channel.sector_count
+    sector = None
+    grid_version = config_version = None
+    # the driver would poll the input buffer before every packet; it is sampled here on a timer instead
+    scan_type = SCAN_TYPES[scan_type]
+    iterator = lidar.iter_measures(scan_type, False)
     scans_count = 0
     start = time.time()
+    sampled = time.perf_counter()
+    is_behind = False
+    dropped = resyncs = 0
     while True:
+        read_start = time.perf_counter()
         try:
             new_scan, quality, angle, distance = next(iterator)
+            if quality is None:  # express scans carry no quality
+                quality = 0
         except RPLidarException as e:
             lidar.logger.warning(e.args[0])
-            iterator = lidar.iter_measures(scan_type, max_buf_meas)
+            resyncs += 1
+            metrics.set('resyncs', resyncs)
+            lidar.stop()
+            iterator = lidar.iter_measures(scan_type, False)
             continue
+        metrics.observe('serial read', time.perf_counter() - read_start)
+        if read_start - sampled >= buffer_period:
+            sampled = read_start
+            channel.stats[channel.HEARTBEAT] = time.time()
+            buffer = lidar._serial.inWaiting()
+            channel.stats[channel.BUFFER] = buffer
+            metrics.set('buffer', buffer)
+            # behind, only points inside the grid are kept; too far behind, the backlog is dropped at once
+            is_behind = buffer > max_buf_meas // 2
+            metrics.set('behind', is_behind)
+            if buffer > max_buf_meas:
+                lidar.logger.warning('Dropping %d bytes behind the live scan', buffer)
+                dropped += buffer
+                metrics.set('dropped bytes', dropped)
+                lidar.stop()
+                lidar.start(scan_type)
+        if recorder:
+            recorder.write(new_scan, quality, angle, distance)
+        if grid_config.version != grid_version:
+            grid_version = grid_config.version
+            bounds = grid_config.read()
+        if config.version != config_version:
+            config_version = config.version
+            x_shift, y_shift, yaw, is_all_points, is_active, is_learning = config.read()
+            if yaw != table_yaw:
+                table_yaw, table = yaw, trig_table(yaw)
+                if not batched:
+                    table = table[0].tolist(), table[1].tolist()
+        next_sector = int(angle / sector_size) % channel.sector_count
+        if sector is None:
+            sector = next_sector
+        # small backward steps are jitter at a sector edge, the measurement stays in the current sector
+        step = (next_sector - sector) % channel.sector_count
+        if 0 < step <= channel.sector_count // 2 or new_scan and channel.sector_count == 1:
+            binning_start = time.perf_counter()
+            n = revolution.size
+            angles, distances = revolution.angles[:n], revolution.distances[:n]
+            bins = (angles * (BACKGROUND_BINS / 360)).astype(np.intp) % BACKGROUND_BINS
+            if is_learning:
+                np.minimum.at(background.learned, bins, distances)
+            is_foreground = distances < background.ranges[bins] - background_margin
+            angles, distances = angles[is_foreground], distances[is_foreground]
+            if not batched:
+                angles, distances = angles.tolist(), distances.tolist()
+            points, simple_grid = transform(angles, distances, bounds, (x_shift, y_shift),
+                                            channel.width, channel.height, is_all_points and not is_behind, table)
+            sector_start = channel.head[0]
+            channel.extend(points)
+            channel.publish(sector_start, simple_grid, sector)
+            sector = (sector + 1) % channel.sector_count
+            while sector != next_sector:
+                channel.publish(channel.head[0], 0, sector)
+                sector = (sector + 1) % channel.sector_count
+            metrics.observe('binning', time.perf_counter() - binning_start)
+            revolution.clear()
         if new_scan:
             if scans_count > min_len:
-                scans[:] = scans_tmp
-                simple_grid[:] = simple_grid_tmp
-                if not is_active.value:
-                    scans[:] = []
-                    simple_grid[:] = [[0] * width for _ in range(height)]
-                    runtime.value = 0
-                    buffer.value = 0
+                runtime = time.time() - start
+                channel.stats[channel.RUNTIME] = runtime
+                channel.stats[channel.REVOLUTION] += 1
+                metrics.observe('revolution', runtime)
+                metrics.set('revolutions/s', 1 / runtime)
+                if not is_active:
+                    if recorder:
+                        recorder.close()
+                    channel.clear()
                     lidar.stop()
                     lidar.stop_motor()
                     lidar.disconnect()
                     return
-                runtime.value = time.time() - start
                 start = time.time()
             scans_count = 0
-            simple_grid_tmp = [[0] * width for _ in range(height)]
-            scans_tmp = []
         if distance > 0:
-            x = distance * math.cos(math.radians(-angle)) + x_shift.value
-            y = distance * math.sin(math.radians(-angle)) + y_shift.value
-            is_in_grid = x0.value <= x <= x1.value and y0.value <= y <= y1.value
-            if is_all_points.value or is_in_grid:
-                scans_tmp.append((x, y))
-            if is_in_grid:
-                j = int((x - x0.value) / (h.value + 1))
-                i = int((y - y0.value) / (h.value + 1))
-                simple_grid_tmp[i][j] += 1
+            revolution.append(quality, angle, distance)
             scans_count += 1
-        buffer.value = lidar._serial.inWaiting()
 
 
 class Lidar:
-    def __init__(self, manager, grid, settings_dict, port):
-        lidar = RPLidar(port, timeout=0.5)
-        lidar.stop()
-        lidar.stop_motor()
-        lidar_info = lidar.get_info()
-        self._serial_number = manager.Value(c_wchar_p, lidar_info['serialnumber'])
-        lidar.disconnect()
+    def __init__(self, grid, settings_dict, port, record=None, replay_speed=1.0, serial_number=None, hwid=None):
+        self.serial_number = serial_number or identify(port, replay_speed)
+        if self.serial_number is None:
+            raise RPLidarException('No lidar answers on ' + port)
+        self.hwid = hwid
         settings = settings_dict.get(self.serial_number)
         self.grid = grid
-        self.scans = manager.list()
-        self._buffer = manager.Value('i', 0)
-        self._runtime = manager.Value('d', 0.0)
-        self.simple_grid = manager.list()
-        self._x_shift = manager.Value('i', settings[1] if settings else 0)
-        self._y_shift = manager.Value('i', settings[2] if settings else 0)
-        self._is_active = manager.Value(c_bool, settings[0] if settings else True)
-        self._is_all_points = manager.Value(c_bool, False)
+        self.sectors = settings_dict.get('sectors', 8)
+        self.channel = LidarChannel(grid.height, grid.width, sectors=self.sectors)
+        self.metrics = Metrics(WORKER_STAGES, WORKER_GAUGES)
+        self.background = SharedArrays([('ranges', np.float64, (BACKGROUND_BINS,)),
+                                        ('learned', np.float64, (BACKGROUND_BINS,))])
+        background = settings_dict.get('background', {}).get(self.serial_number)
+        self.background.ranges[:] = decode_background(background) if background else np.inf
+        self.background.learned.fill(np.inf)
+        self.background_margin = settings_dict.get('background_margin', 50)
+        self.config = SharedConfig(('x_shift', 'y_shift', 'yaw', 'is_all_points', 'is_active', 'is_learning'), {
+            'x_shift': settings[1] if settings else 0,
+            'y_shift': settings[2] if settings else 0,
+            'yaw': settings[3] if settings and len(settings) > 3 else 0,
+            'is_all_points': False,
+            'is_active': settings[0] if settings else True,
+        })
         self.port = port
-        self.scan_type = 'normal'
-        self.max_buf_meas = 2000
+        self.scan_type = settings_dict.get('scan_type', 'normal')
+        self.max_buf_meas = settings_dict.get('max_buf_meas', 2000)
+        self.batched = True
+        self.record = record
+        self.replay_speed = replay_speed
+        self.replay_start = None
         self.process = None
+        self.started = 0
+        self.restarts = 0
+        self.lock = threading.Lock()
         if self.is_active:
             self.start()
 
     def start(self):
+        with self.lock:
+            self._spawn()
+
+    def _spawn(self):
         self.process = multiprocessing.Process(target=lidar_process, kwargs={
-            'scans': self.scans,
-            'buffer': self._buffer,
-            'simple_grid': self.simple_grid,
-            'width': self.grid.width,
-            'height': self.grid.height,
-            'runtime': self._runtime,
-            'x0': self.grid._x0,
-            'y0': self.grid._y0,
-            'x1': self.grid._x1,
-            'y1': self.grid._y1,
-            'h': self.grid._h,
-            'x_shift': self._x_shift,
-            'y_shift': self._y_shift,
-            'is_active': self._is_active,
-            'is_all_points': self._is_all_points,
+            'channel': self.channel,
+            'grid_config': self.grid.config,
+            'config': self.config,
+            'metrics': self.metrics,
+            'background': self.background,
             'port': self.port,
             'scan_type': self.scan_type,
-            'max_buf_meas': self.max_buf_meas
+            'max_buf_meas': self.max_buf_meas,
+            'batched': self.batched,
+            'record': self.record,
+            'serial_number': self.serial_number,
+            'replay_speed': self.replay_speed,
+            'replay_start': self.replay_start,
+            'background_margin': self.background_margin
         })
         self.is_active = True
+        self.started = time.time()
         self.process.start()
 
-    def stop(self):
-        self.is_active = False
-        while self.process.is_alive():
-            time.sleep(.1)
+    def _join(self, timeout, grace=1.0):
+        # the worker exits by itself at the end of a revolution, a hung one is terminated
+        if not self.process:
+            return
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(grace)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+    def stop(self, timeout=3):
+        with self.lock:
+            self.is_active = False
+            self._join(timeout)
 
     def restart(self):
         self.stop()
         self.start()
 
+    def respawn(self):
+        # replaces a stalled worker; its last grid is cleared so fusion stops using it at once
+        with self.lock:
+            if not self.is_active:
+                return
+            self._join(0, 0.2)
+            self.channel.clear()
+            self.restarts += 1
+            self._spawn()
+
+    def kill(self):
+        with self.lock:
+            self._join(0, 0.2)
+            self.channel.clear()
+
+    def close(self):
+        self.channel.close()
+        self.config.close()
+        self.metrics.close()
+        self.background.close()
+
+    def learn_background(self):
+        # the worker keeps the nearest range per angle bin until keep_background, the room must be empty
+        self.background.learned.fill(np.inf)
+        self.config['is_learning'] = True
+
+    def keep_background(self):
+        if not self.is_learning:
+            return
+        self.config['is_learning'] = False
+        learned = self.background.learned
+        learned = np.minimum(np.minimum(learned, np.roll(learned, 1)), np.roll(learned, -1))
+        # bins that saw nothing keep their old range
+        self.background.ranges[:] = np.where(np.isfinite(learned), learned, self.background.ranges)
+
+    def clear_background(self):
+        self.background.ranges.fill(np.inf)
+
+    def align_to(self, reference):
+        # corrects the pose so the last scan overlaps the last scan of reference, both need all points
+        angle, shift = align(self.scans, reference.scans)
+        x, y = _rotation(np.radians(angle)) @ (self.x_shift, self.y_shift) + shift
+        self.x_shift, self.y_shift = round(x), round(y)
+        self.yaw = round((self.yaw + angle + 180) % 360 - 180, 2)
+        return angle, shift
+
     @property
-    def buffer(self):
-        return self._buffer.value
+    def has_background(self):
+        return bool(np.isfinite(self.background.ranges).any())
+
+    @property
+    def is_learning(self):
+        return bool(self.config['is_learning'])
 
-    @buffer.setter
-    def buffer(self, buffer):
-        self._buffer.value = buffer
+    @property
+    def scans(self):
+        return self.channel.read()[0]
 
     @property
-    def runtime(self):
-        return self._runtime.value
+    def simple_grid(self):
+        return self.channel.read_grid()
+
+    @property
+    def frame(self):
+        return self.channel.read_frame()
+
+    @property
+    def heartbeat(self):
+        return float(self.channel.stats[LidarChannel.HEARTBEAT])
 
-    @runtime.setter
-    def runtime(self, runtime):
-        self._runtime.value = runtime
+    @property
+    def revolutions(self):
+        return int(self.channel.stats[LidarChannel.REVOLUTION])
+
+    @property
+    def buffer(self):
+        return int(self.channel.stats[LidarChannel.BUFFER])
+
+    @property
+    def runtime(self):
+        return float(self.channel.stats[LidarChannel.RUNTIME])
 
     @property
     def is_active(self):
-        return self._is_active.value
+        return bool(self.config['is_active'])
 
     @is_active.setter
     def is_active(self, is_active):
-        self._is_active.value = is_active
+        self.config['is_active'] = is_active
 
     @property
     def is_all_points(self):
-        return self._is_all_points.value
+        return bool(self.config['is_all_points'])
 
     @is_all_points.setter
     def is_all_points(self, is_all_points):
-        self._is_all_points.value = is_all_points
+        if is_all_points != self.is_all_points:
+            self.config['is_all_points'] = is_all_points
 
     @property
     def x_shift(self):
-        return self._x_shift.value
+        return int(self.config['x_shift'])
 
     @x_shift.setter
     def x_shift(self, x_shift):
-        self._x_shift.value = x_shift
+        self.config['x_shift'] = x_shift
 
     @property
     def y_shift(self):
-        return self._y_shift.value
+        return int(self.config['y_shift'])
 
     @y_shift.setter
     def y_shift(self, y_shift):
-        self._y_shift.value = y_shift
+        self.config['y_shift'] = y_shift
 
     @property
-    def serial_number(self):
-        return self._serial_number.value
+    def yaw(self):
+        return float(self.config['yaw'])
 
-    @serial_number.setter
-    def serial_number(self, serial_number):
-        self._serial_number.value = serial_number
+    @yaw.setter
+    def yaw(self, yaw):
+        self.config['yaw'] = yaw
@@ -0,0 +1,97 @@
+import math
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from shm import SharedArrays
+
+BUCKETS = 32  # bucket b counts durations below 2 ** b microseconds
+WORKER_STAGES = ('serial read', 'revolution', 'binning')
+WORKER_GAUGES = ('buffer', 'revolutions/s', 'behind', 'dropped bytes', 'resyncs')
+ENGINE_STAGES = ('fusion', 'tracking', 'state update', 'tick', 'render')
+
+
+class Metrics(SharedArrays):
+    # log2 histograms of stage durations and last-value gauges, written by one process and read by the exporter
+    def __init__(self, stages, gauges=(), name=None):
+        self.stages = tuple(stages)
+        self.gauges = tuple(gauges)
+        self._stages = {stage: i for i, stage in enumerate(self.stages)}
+        self._gauges = {gauge: i for i, gauge in enumerate(self.gauges)}
+        super().__init__([
+            ('counts', np.int64, (len(self.stages), BUCKETS)),
+            ('sums', np.float64, (len(self.stages),)),
+            ('values', np.float64, (max(len(self.gauges), 1),)),
+        ], name)
+
+    def _args(self):
+        return self.stages, self.gauges
+
+    def observe(self, stage, seconds):
+        i = self._stages[stage]
+        self.counts[i, min(max(math.frexp(seconds * 1e6)[1], 0), BUCKETS - 1)] += 1
+        self.sums[i] += seconds
+
+    def set(self, gauge, value):
+        self.values[self._gauges[gauge]] = value
+
+    def percentile(self, stage, q):
+        counts = self.counts[self._stages[stage]]
+        total = counts.sum()
+        if not total:
+            return 0.0
+        return 2.0 ** int(np.searchsorted(np.cumsum(counts), total * q)) / 1e6
+
+
+def format_metrics(sources):
+    lines = []
+    for source, metrics in sources:
+        for i, stage in enumerate(metrics.stages):
+            counts = np.cumsum(metrics.counts[i]).tolist()
+            labels = 'source="{}",stage="{}"'.format(source, stage)
+            for b, count in enumerate(counts):
+                lines.append('rainroom_stage_seconds_bucket{{{},le="{:g}"}} {}'.format(labels, 2.0 ** b / 1e6, count))
+            lines.append('rainroom_stage_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, counts[-1]))
+            lines.append('rainroom_stage_seconds_sum{{{}}} {:.6f}'.format(labels, metrics.sums[i]))
+            lines.append('rainroom_stage_seconds_count{{{}}} {}'.format(labels, counts[-1]))
+        for i, gauge in enumerate(metrics.gauges):
+            lines.append('rainroom_gauge{{source="{}",name="{}"}} {:g}'.format(source, gauge, metrics.values[i]))
+    return '\n'.join(lines) + '\n'
+
+
+class Exporter(threading.Thread):
+    # serves the metrics of all processes as text on a local port and/or rewrites them to a file periodically
+    def __init__(self, sources, port=None, path=None, period=5.0):
+        super().__init__(daemon=True)
+        self.sources = sources
+        self.path = path
+        self.period = period
+        self._stopped = threading.Event()
+        self._server = None
+        if port:
+            exporter = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = format_metrics(exporter.sources()).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def run(self):
+        while self.path and not self._stopped.wait(self.period):
+            with open(self.path, 'w') as file:
+                file.write(format_metrics(self.sources()))
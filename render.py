@@ -0,0 +1,83 @@
+import numpy as np
+from grid import State
+
+FILL = {State.GREEN: 'green', State.YELLOW: 'yellow'}
+
+
+def decimate(points, voxel, max_points):
+    if len(points) == 0:
+        return points
+    cells = np.floor(points / voxel).astype(np.int64)
+    _, index = np.unique(cells[:, 0] * 1000003 + cells[:, 1], return_index=True)
+    index.sort()
+    if len(index) > max_points:
+        index = index[np.linspace(0, len(index) - 1, max_points).astype(np.intp)]
+    return points[index]
+
+
+class Renderer:
+    # keeps canvas items between frames: the grid is drawn once, cells are recolored on state change
+    # and point circles are moved instead of recreated
+    def __init__(self, graph, grid, colors, radius=20, voxel=40, max_points=400):
+        self.graph = graph
+        self.grid = grid
+        self.colors = colors
+        self.radius = radius
+        self.voxel = voxel
+        self.max_points = max_points
+        self._version = None
+        self._cells = []
+        self._states = None
+        self._clouds = []
+        self._visible = []
+
+    def reset(self):
+        self._version = None
+
+    def _draw_grid(self):
+        grid = self.grid
+        self.graph.Erase()
+        self._cells = [[self.graph.DrawRectangle((grid.x0 + j * grid.h, grid.y0 + i * grid.h),
+                                                 (grid.x0 + (j + 1) * grid.h, grid.y0 + (i + 1) * grid.h))
+                        for j in range(grid.width)] for i in range(grid.height)]
+        grid.print_labels(self.graph)
+        self._states = None
+        self._clouds = [[] for _ in self.colors]
+        self._visible = [0 for _ in self.colors]
+        self._version = grid.config.version
+
+    def _to_canvas(self, points):
+        (x0, y0), (x1, y1) = self.graph.BottomLeft, self.graph.TopRight
+        width, height = self.graph.CanvasSize
+        x = (points[:, 0] - x0) * (width / (x1 - x0))
+        y = height - (points[:, 1] - y0) * (height / (y1 - y0))
+        return np.column_stack((x, y)), self.radius * width / (x1 - x0)
+
+    def _update_cells(self, states):
+        canvas = self.graph.TKCanvas
+        changed = np.ones(states.shape, bool) if self._states is None else states != self._states
+        for i, j in zip(*np.nonzero(changed)):
+            canvas.itemconfig(self._cells[i][j], fill=FILL.get(int(states[i, j]), ''))
+        self._states = states
+
+    def _update_cloud(self, k, points):
+        canvas = self.graph.TKCanvas
+        items, color = self._clouds[k], self.colors[k]
+        xy, r = self._to_canvas(decimate(points, self.voxel, self.max_points))
+        for n, (x, y) in enumerate(xy.tolist()):
+            if n < len(items):
+                canvas.coords(items[n], x - r, y - r, x + r, y + r)
+                if n >= self._visible[k]:
+                    canvas.itemconfig(items[n], state='normal')
+            else:
+                items.append(canvas.create_oval(x - r, y - r, x + r, y + r, fill=color, outline=color))
+        for item in items[len(xy):self._visible[k]]:
+            canvas.itemconfig(item, state='hidden')
+        self._visible[k] = len(xy)
+
+    def update(self, states, clouds):
+        if self._version != self.grid.config.version:
+            self._draw_grid()
+        self._update_cells(states)
+        for k, points in enumerate(clouds[:len(self.colors)]):
+            self._update_cloud(k, points)
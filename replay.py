@@ -0,0 +1,101 @@
+import os
+import time
+import numpy as np
+
+SUFFIX = '.rplidar'
+MAGIC = b'RAINROOM-RPLIDAR'
+HEADER = np.dtype([('magic', 'S16'), ('port', 'S64'), ('serial_number', 'S64'), ('start', '<f8')])
+RECORD = np.dtype([('t', '<f8'), ('new_scan', 'u1'), ('quality', 'u1'), ('angle', '<f4'), ('distance', '<f4')])
+
+
+def is_recording(port):
+    return port.endswith(SUFFIX)
+
+
+class Recorder:
+    # appends raw iter_measures tuples to a file that load() maps back without parsing
+    def __init__(self, path, port, serial_number, size=4096):
+        self.start = time.time()
+        self._file = open(path, 'wb')
+        header = np.array([(MAGIC, port.encode(), serial_number.encode(), self.start)], HEADER)
+        self._file.write(header.tobytes())
+        self._records = np.zeros(size, RECORD)
+        self._size = 0
+
+    def write(self, new_scan, quality, angle, distance):
+        self._records[self._size] = time.time() - self.start, new_scan, quality, angle, distance
+        self._size += 1
+        if self._size == len(self._records):
+            self.flush()
+
+    def extend(self, records):
+        self.flush()
+        self._file.write(np.asarray(records, RECORD).tobytes())
+
+    def flush(self):
+        self._file.write(self._records[:self._size].tobytes())
+        self._file.flush()
+        self._size = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+def load(path):
+    header = np.fromfile(path, HEADER, count=1)[0]
+    if header['magic'] != MAGIC:
+        raise ValueError('Not a lidar recording: ' + path)
+    count = (os.path.getsize(path) - HEADER.itemsize) // RECORD.itemsize
+    records = np.memmap(path, RECORD, 'r', offset=HEADER.itemsize, shape=(count,))
+    return header['port'].decode(), header['serial_number'].decode(), records
+
+
+class _ReplaySerial:
+    def inWaiting(self):
+        return 0
+
+
+class ReplayLidar:
+    # stands in for RPLidar, yields a recording at its original pace scaled by speed (0 is as fast as possible);
+    # start pins the wall clock time of the first record, so several replays stay in step
+    def __init__(self, path, speed=1.0, loop=True, logger=None, timeout=None, start=None):
+        self.port, self.serial_number, self.records = load(path)
+        self.speed = speed
+        self.start_time = start
+        self.loop = loop
+        self.logger = logger
+        self._serial = _ReplaySerial()
+
+    def get_info(self):
+        return {'serialnumber': self.serial_number, 'model': None, 'firmware': None, 'hardware': None}
+
+    def iter_measures(self, scan_type='normal', max_buf_meas=3000, chunk=4096):
+        if not len(self.records):
+            return
+        duration = float(self.records['t'][-1])
+        offset = 0
+        start = self.start_time or time.time()
+        while True:
+            for i in range(0, len(self.records), chunk):
+                for t, new_scan, quality, angle, distance in self.records[i:i + chunk].tolist():
+                    if self.speed:
+                        delay = (t + offset) / self.speed - (time.time() - start)
+                        if delay > 0.001:
+                            time.sleep(delay)
+                    yield bool(new_scan), quality, angle, distance
+            if not self.loop:
+                return
+            offset += duration
+
+    def start(self, scan_type='normal'):
+        pass
+
+    def stop(self):
+        pass
+
+    def stop_motor(self):
+        pass
+
+    def disconnect(self):
+        pass
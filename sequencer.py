@@ -0,0 +1,90 @@
+import time
+import threading
+import numpy as np
+from grid import State
+from bus import ON, OFF, WritePlanner
+
+
+def blink(height, width):
+    return [np.ones((height, width), bool), np.zeros((height, width), bool)]
+
+
+def checkerboard(height, width):
+    board = np.add.outer(np.arange(height), np.arange(width)) % 2 == 0
+    return [board, ~board]
+
+
+def wave(height, width, band=1, axis=1):
+    # a band of rain crossing the grid and coming back
+    size = (height, width)[axis]
+    positions = list(range(size)) + list(range(size - 2, 0, -1))
+    index = np.indices((height, width))[axis]
+    return [(index >= p) & (index < p + band) for p in positions]
+
+
+def chase(height, width, length=3):
+    # a run of showers snaking row by row
+    order = [(i, j if i % 2 == 0 else width - 1 - j) for i in range(height) for j in range(width)]
+    frames = []
+    for k in range(len(order)):
+        frame = np.zeros((height, width), bool)
+        for i, j in order[k:k + length]:
+            frame[i, j] = True
+        frames.append(frame)
+    return frames
+
+
+PATTERNS = {'blink': blink, 'checkerboard': checkerboard, 'wave': wave, 'chase': chase}
+SHOWS = {
+    'special': [{'pattern': 'blink', 'duration': 5}],
+    'show': [{'pattern': 'wave', 'duration': 0.4, 'repeat': 2}, {'pattern': 'checkerboard', 'duration': 1, 'repeat': 4},
+             {'pattern': 'chase', 'duration': 0.25, 'length': 4}],
+}
+
+
+def compile_show(grid, steps):
+    # every frame becomes the register batches that change from the previous frame, with its duration;
+    # the first frame is written in full, so every loop starts from a known state
+    planner = WritePlanner()
+    compiled = []
+    previous = None
+    for step in steps:
+        kwargs = {key: value for key, value in step.items() if key not in ('pattern', 'duration', 'repeat')}
+        frames = PATTERNS[step['pattern']](grid.height, grid.width, **kwargs)
+        for frame in frames * step.get('repeat', 1):
+            values = np.where(frame[grid._cells], ON, OFF).tolist()
+            targets = list(zip(grid._rs_nums, grid._registers, values))
+            changed = targets if previous is None else [target for target, value in zip(targets, previous)
+                                                        if target[2] != value]
+            compiled.append((frame, planner.plan(changed), step['duration']))
+            previous = values
+    return compiled
+
+
+class Sequencer(threading.Thread):
+    # plays compiled frames in a loop; frame k is due at start + the durations before it on the monotonic clock,
+    # and is sent early by the time the last bus write took, so late writes don't add up
+    def __init__(self, grid, dispatcher, compiled):
+        super().__init__(daemon=True)
+        self.grid = grid
+        self.dispatcher = dispatcher
+        self.compiled = compiled
+        self.frame = 0
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        if not self.compiled:
+            return
+        due = time.monotonic()
+        while True:
+            for k, (frame, batches, duration) in enumerate(self.compiled):
+                if self._stopped.wait(max(0, due - self.dispatcher.runtime - time.monotonic())):
+                    return
+                self.dispatcher.submit_batches(batches)
+                self.grid.state[self.grid._cells] = np.where(frame[self.grid._cells], State.GREEN, State.CLEAR)
+                self.frame = k
+                due += duration
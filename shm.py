@@ -0,0 +1,159 @@
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+
+def _attach(cls, args, name):
+    return cls(*args, name=name)
+
+
+class SharedArrays:
+    # numpy views over one shared memory block, picklable by name so workers attach without copying
+    def __init__(self, layout, name=None):
+        self._layout = layout
+        self._owner = name is None
+        offsets = []
+        size = 0
+        for field, dtype, shape in layout:
+            offsets.append(size)
+            size += -(-np.dtype(dtype).itemsize * int(np.prod(shape)) // 8) * 8
+        self._shm = shared_memory.SharedMemory(name=name, create=self._owner, size=max(size, 8))
+        for (field, dtype, shape), offset in zip(layout, offsets):
+            setattr(self, field, np.ndarray(shape, dtype, buffer=self._shm.buf, offset=offset))
+
+    def _args(self):
+        return self._layout,
+
+    def __reduce__(self):
+        return _attach, (self.__class__, self._args(), self._shm.name)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def close(self):
+        for field, _, _ in self._layout:
+            self.__dict__.pop(field, None)
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class SharedConfig(SharedArrays):
+    # named values with a version counter bumped on every write, so readers re-read only after a change
+    def __init__(self, fields, values=None, name=None):
+        self.fields = tuple(fields)
+        self._index = {field: i for i, field in enumerate(self.fields)}
+        super().__init__([('values', np.float64, (len(self.fields) + 1,))], name)
+        if values:
+            for field, value in values.items():
+                self[field] = value
+
+    def _args(self):
+        return self.fields, None
+
+    def __getitem__(self, field):
+        return self.values[self._index[field]]
+
+    def __setitem__(self, field, value):
+        self.values[self._index[field]] = value
+        self.values[-1] += 1
+
+    @property
+    def version(self):
+        return self.values[-1]
+
+    def read(self):
+        return self.values[:-1].tolist()
+
+
+class LidarChannel(SharedArrays):
+    # single writer (lidar worker), many readers; a ring of scan points plus a rolling grid made of
+    # the latest contribution of every angular sector, guarded by a seqlock
+    RUNTIME, BUFFER, TIMESTAMP, REVOLUTION, HEARTBEAT = range(5)
+    SPINS = 10000  # reads tried before a torn one is returned, so a dead writer can't hang a reader
+
+    def __init__(self, height, width, capacity=8192, sectors=1, name=None):
+        self.height = height
+        self.width = width
+        self.capacity = capacity
+        self.sector_count = sectors
+        super().__init__([
+            ('seq', np.uint64, (1,)),
+            ('head', np.int64, (3,)),  # points written, published window start and end
+            ('stats', np.float64, (5,)),
+            ('points', np.float64, (capacity, 2)),
+            ('grid', np.int32, (height, width)),
+            ('sectors', np.int32, (sectors, height, width)),
+            ('sector_heads', np.int64, (sectors,)),  # ring position where each sector's points start
+        ], name)
+
+    def _args(self):
+        return self.height, self.width, self.capacity, self.sector_count
+
+    def extend(self, points):
+        points = np.asarray(points, np.float64).reshape(-1, 2)[-self.capacity:]
+        head = int(self.head[0])
+        i = head % self.capacity
+        n = min(len(points), self.capacity - i)
+        self.points[i:i + n] = points[:n]
+        self.points[:len(points) - n] = points[n:]
+        self.head[0] = head + len(points)
+
+    def publish(self, start, grid, sector=0):
+        end = self.head[0]
+        self.seq[0] += 1
+        self.sectors[sector] = grid
+        self.sector_heads[sector] = start
+        self.grid[:] = self.sectors.sum(0)
+        self.head[1] = max(self.sector_heads.min(), end - self.capacity)
+        self.head[2] = end
+        self.stats[self.TIMESTAMP] = time.time()
+        self.seq[0] += 1
+
+    def clear(self):
+        # the writer is gone, it may have died between the two increments of publish
+        self.seq[0] += self.seq[0] & 1
+        self.seq[0] += 1
+        self.sectors[:] = 0
+        self.sector_heads[:] = self.head[0]
+        self.grid[:] = 0
+        self.head[1:] = self.head[0]
+        self.stats[:self.REVOLUTION] = 0
+        self.seq[0] += 1
+
+    def _ring(self, start, end):
+        i, j = start % self.capacity, end % self.capacity
+        if start == end:
+            return self.points[:0].copy()
+        if i < j:
+            return self.points[i:j].copy()
+        return np.concatenate((self.points[i:], self.points[:j]))
+
+    def read_grid(self):
+        for _ in range(self.SPINS):
+            seq = self.seq[0]
+            grid = self.grid.copy()
+            if not seq & 1 and self.seq[0] == seq:
+                break
+        return grid
+
+    def read_frame(self):
+        # grid with the time it was published and the number of revolutions completed before it
+        for _ in range(self.SPINS):
+            seq = self.seq[0]
+            grid = self.grid.copy()
+            timestamp, revolution = self.stats[self.TIMESTAMP], self.stats[self.REVOLUTION]
+            if not seq & 1 and self.seq[0] == seq:
+                break
+        return grid, float(timestamp), int(revolution)
+
+    def read(self):
+        for _ in range(self.SPINS):
+            seq = self.seq[0]
+            start, end = int(self.head[1]), int(self.head[2])
+            points = self._ring(start, end)
+            grid = self.grid.copy()
+            if not seq & 1 and self.seq[0] == seq and self.head[0] - start <= self.capacity:
+                return points, grid
+        return self.points[:0].copy(), self.grid.copy()
@@ -1,194 +1,148 @@
 #!/usr/bin/python
 import time
-import multiprocessing
-import serial.tools.list_ports
-import socket
-import json
+import argparse
 import PySimpleGUI as sg
 import gui
-from grid import Grid
-from lidar import Lidar
-from interval import Interval
-from modbus_tk import modbus_rtu_over_tcp
+from render import Renderer
+from controller import Controller, load_settings, find_ports
+from api import ApiServer, Client
+from zones import Site
 
 
-def special_mode(grid, master):
-    if grid.last_static_mode:
-        grid.off_all(master)
-    else:
-        grid.on_all(master)
-
-
-def save_settings(lidars, grid):
-    settings = {}
-    for lidar in lidars:
-        settings[lidar.serial_number] = lidar.is_active, lidar.x_shift, lidar.y_shift
-    settings['x'] = grid.x0
-    settings['y'] = grid.y0
-    settings['sens'] = grid.sens
-    with open('settings.cfg', 'w') as file:
-        json.dump(settings, file)
-
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replay', nargs='+', metavar='FILE', help='lidar recordings to use instead of COM ports')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 replays as fast as possible')
+    parser.add_argument('--record', metavar='DIR', help='record raw lidar measurements to DIR')
+    parser.add_argument('--metrics-port', type=int, help='serve stage latency metrics on this local port')
+    parser.add_argument('--metrics-file', help='rewrite stage latency metrics to this file every few seconds')
+    parser.add_argument('--api-port', type=int, help='also serve the control API on this local port')
+    parser.add_argument('--connect', nargs='+', metavar='URL',
+                        help='attach to the zones of a running daemon instead of starting one')
+    return parser.parse_args()
 
-def load_settings():
-    try:
-        with open('settings.cfg', 'r') as file:
-            return json.load(file)
-    except:
-        return {'x': 0, 'y': 0, 'sens': 0}
 
-
-def main():
-    settings = load_settings()
-    com_ports = [com[0] for com in serial.tools.list_ports.comports() if com[0] != 'COM1']
-    grid = Grid(settings)
-    manager = multiprocessing.Manager()
-    lidars = [Lidar(manager, grid, settings, com) for i, com in enumerate(com_ports)]
-    window = gui.get_window(lidars, grid)
+def run_mode(window, controller, mode, frame_time):
+    # blocks while the mode checkbox is checked; returns False if the window was closed
+    grid = controller.grid
     graph = window['-GRAPH-']
-    colors = ['red', 'blue', 'orange', 'pink']
-    master = modbus_rtu_over_tcp.RtuOverTcpMaster(host='192.168.0.191', port=9761, timeout_in_sec=0.5)
-    modbus_runtime = 0
+    key = '-' + mode.upper() + '-'
+    controller.set_mode(mode=mode)
+    gui.set_window_disabled(window, True)
+    window[key].update(disabled=False)
+    window['-SHOWERS STATE-'].update(controller.status()['state'])
     while True:
-        start = time.time()
-        grid.reset_state()
+        states, _, _ = controller.frame()
         graph.Erase()
-        grid.update_states(lidars)
-        grid.print(graph)
+        if mode == 'interactive':
+            grid.print_interactive(graph)
+        else:
+            grid.print(graph, states)
+        event, values = window.read(timeout=int(frame_time * 1000))
+        if event in (sg.WIN_CLOSED, key):
+            break
+        if event == '-GRAPH-':
+            controller.switch(x=values['-GRAPH-'][0], y=values['-GRAPH-'][1])
+    controller.set_mode(mode=None)
+    if event == sg.WIN_CLOSED:
+        return False
+    gui.set_window_disabled(window, False)
+    return True
 
-        for color, lidar in zip(colors, lidars):
-            for x, y in lidar.scans:
-                graph.DrawCircle((x, y), 20, line_color=color, fill_color=color)
 
-        event, values = window.read(timeout=0)
+def run_window(zones, zone):
+    # returns the zone picked in the window, or None once the window is closed
+    controller = zones[zone]
+    grid = controller.grid
+    status = controller.status()
+    window = gui.get_window(status, grid, list(zones) if len(zones) > 1 else (), zone)
+    graph = window['-GRAPH-']
+    renderer = Renderer(graph, grid, ['red', 'blue', 'orange', 'pink'])
+    frame_time = 1 / controller.settings.get('frame_rate', 15)
+    last_frame = 0
+    errors = status['errors']
+    while True:
+        timeout = max(0, last_frame + frame_time - time.monotonic())
+        event, values = window.read(timeout=int(timeout * 1000))
+        if event != sg.WIN_CLOSED and time.monotonic() - last_frame >= frame_time:
+            last_frame = time.monotonic()
+            status = controller.status()
+            states, _, scans = controller.frame()
+            renderer.update(states, scans)
+            controller.observe('render', time.monotonic() - last_frame)
+            gui.update_window(window, status)
+            if status['errors'] > errors:
+                gui.popup()
+            errors = status['errors']
 
         if event == sg.WIN_CLOSED:
-            for lidar in lidars:
-                if lidar.is_active:
-                    lidar.stop()
-            return
+            return None
+        if event == '-ZONE-' and values['-ZONE-'] != zone:
+            window.close()
+            return values['-ZONE-']
         if event == '-X-':
-            grid.x0 = values['-X-'] * 10
-            grid.x1 = grid.x0 + grid.width * (grid.h + 1)
-            save_settings(lidars, grid)
+            controller.set_origin(x0=values['-X-'] * 10)
         if event == '-Y-':
-            grid.y0 = values['-Y-'] * 10
-            grid.y1 = grid.y0 + grid.height * (grid.h + 1)
-            save_settings(lidars, grid)
+            controller.set_origin(y0=values['-Y-'] * 10)
         if event == '-SENS-':
-            grid.sens = values['-SENS-']
-            save_settings(lidars, grid)
+            controller.set_sens(sens=values['-SENS-'])
+        if event == '-ALIGN-':
+            controller.align()
+            gui.update_poses(window, controller.status())
+        if event == '-BACKGROUND-':
+            controller.learn_background(is_learning=values['-BACKGROUND-'])
         if event == '-ACTIVATE-':
-            window['-SHOWERS STATE-'].update('ACTIVE', text_color='green')
-            grid.activate()
+            controller.activate()
         if event == '-ON ALL-':
-            grid.deactivate()
-            try:
-                grid.on_all(master)
-                window['-SHOWERS STATE-'].update('ON ALL', text_color='green')
-            except socket.timeout:
-                gui.popup()
-                window['-SHOWERS STATE-'].update('UNDEFINED', text_color='orange')
+            controller.on_all()
         if event == '-OFF ALL-':
-            grid.deactivate()
-            try:
-                grid.off_all(master)
-                window['-SHOWERS STATE-'].update('OFF ALL', text_color='red')
-            except socket.timeout:
-                gui.popup()
-                window['-SHOWERS STATE-'].update('UNDEFINED', text_color='orange')
-
-        if event == '-INTERACTIVE-':
-            grid.deactivate()
-            grid.reset_state()
-            grid.off_all(master)
-            gui.set_window_disabled(window, True)
-            window['-INTERACTIVE-'].update(disabled=False)
-            window['-SHOWERS STATE-'].update('INTERACTIVE', text_color='green')
-            for lidar in lidars:
-                if lidar.is_active:
-                    lidar.stop()
-            while True:
-                graph.Erase()
-                grid.print_interactive(graph)
-                event, values = window.read(timeout=0)
-                if event == sg.WIN_CLOSED:
-                    grid.off_all(master)
-                    return
-                if event == '-INTERACTIVE-':
-                    break
-                # here was is_socket_open() check
-                if event == '-GRAPH-' and master is not None:
-                    x = values['-GRAPH-'][0]
-                    y = values['-GRAPH-'][1]
-                    try:
-                        grid.switch(master, x, y)
-                    except socket.timeout:
-                        gui.popup()
-            try:
-                grid.off_all(master)
-                window['-SHOWERS STATE-'].update('OFF ALL', text_color='red')
-            except socket.timeout:
-                window['-SHOWERS STATE-'].update('UNDEFINED', text_color='orange')
-            gui.set_window_disabled(window, False)
-            # grid.set_prev_state()
-            for i, lidar in enumerate(lidars):
-                if values['-LIDAR CHECK-' + str(i)]:
-                    lidar.start()
-        if event == '-SPECIAL-':
-            grid.deactivate()
-            grid.reset_state()
-            grid.on_all(master)
-            gui.set_window_disabled(window, True)
-            for lidar in lidars:
-                if lidar.is_active:
-                    lidar.stop()
-            window['-SPECIAL-'].update(disabled=False)
-            window['-SHOWERS STATE-'].update('')
-            interval = Interval(5, special_mode, args=[grid, master])
-            interval.start()
-            while True:
-                graph.Erase()
-                grid.print(graph)
-                event, values = window.read(timeout=0)
-                if event in (sg.WIN_CLOSED, '-SPECIAL-'):
-                    break
-            interval.stop()
-            try:
-                grid.off_all(master)
-                window['-SHOWERS STATE-'].update('OFF ALL', text_color='red')
-            except socket.timeout:
-                window['-SHOWERS STATE-'].update('UNDEFINED', text_color='orange')
-            if event == sg.WIN_CLOSED:
-                return
-            gui.set_window_disabled(window, False)
-            grid.set_prev_state()
-            for i, lidar in enumerate(lidars):
-                if values['-LIDAR CHECK-' + str(i)]:
-                    lidar.start()
-        for i, lidar in enumerate(lidars):
-            lidar.is_all_points = values['-ALL-']
+            controller.off_all()
+        if event in ('-ALL-', '-INSIDE GRID-'):
+            controller.set_all_points(is_all_points=values['-ALL-'])
+        if event in ('-INTERACTIVE-', '-SPECIAL-'):
+            if not run_mode(window, controller, event.strip('-').lower(), frame_time):
+                return None
+            renderer.reset()
+        for i in range(len(status['lidars'])):
             if event == '-LIDAR CHECK-' + str(i):
-                if values['-LIDAR CHECK-' + str(i)]:
-                    lidar.start()
-                else:
-                    lidar.stop()
-                save_settings(lidars, grid)
+                controller.set_lidar(i=i, is_active=values['-LIDAR CHECK-' + str(i)])
             if event == '-LIDAR X-' + str(i):
-                lidar.x_shift = values['-LIDAR X-' + str(i)] * 10
-                save_settings(lidars, grid)
+                controller.set_lidar(i=i, x_shift=values['-LIDAR X-' + str(i)] * 10)
             if event == '-LIDAR Y-' + str(i):
-                lidar.y_shift = values['-LIDAR Y-' + str(i)] * 10
-                save_settings(lidars, grid)
-        try:
-            modbus_runtime = grid.update_showers(master)
-        except socket.timeout:
-            grid.deactivate()
-            window['-SHOWERS STATE-'].update('UNDEFINED', text_color='orange')
-            gui.popup()
+                controller.set_lidar(i=i, y_shift=values['-LIDAR Y-' + str(i)] * 10)
+            if event == '-LIDAR YAW-' + str(i):
+                controller.set_lidar(i=i, yaw=values['-LIDAR YAW-' + str(i)])
 
-        runtime = time.time() - start
-        gui.update_window(window, runtime, modbus_runtime, lidars)
+
+def main():
+    args = parse_args()
+    site = api = None
+    if args.connect:
+        zones = {}
+        for url in args.connect:
+            client = Client(url)
+            zones[client.settings.get('zone', url)] = client
+    elif load_settings().get('zones'):
+        site = Site(args.replay or find_ports(), record=args.record, speed=args.speed, api_port=args.api_port or 8765,
+                    metrics_port=args.metrics_port, metrics_file=args.metrics_file)
+        zones = site.zones
+    else:
+        controller = Controller(args.replay or find_ports(), record=args.record, speed=args.speed,
+                                metrics_port=args.metrics_port, metrics_file=args.metrics_file)
+        api = ApiServer(controller, args.api_port) if args.api_port else None
+        if api:
+            api.start()
+        zones = {None: controller}
+    zone = next(iter(zones))
+    while zone is not None:
+        zone = run_window(zones, zone)
+    if api:
+        api.stop()
+    if site:
+        site.close()
+    else:
+        for controller in zones.values():
+            controller.close()
 
 
 if __name__ == '__main__':
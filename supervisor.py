@@ -0,0 +1,61 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Supervisor(threading.Thread):
+    # restarts lidar workers whose heartbeat or revolution count stops; a failing worker waits longer before
+    # every new attempt, the other lidars are not touched
+    def __init__(self, lidars, stall=0.5, revolution_timeout=1.0, startup=5.0, backoff=0.5, max_backoff=30.0,
+                 recovery=10.0, period=0.1):
+        super().__init__(daemon=True)
+        self.lidars = lidars
+        self.stall = stall
+        self.revolution_timeout = revolution_timeout
+        self.startup = startup
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.recovery = recovery
+        self.period = period
+        self.failures = {}  # lidar port -> failed attempts in a row
+        self._watch = {}  # lidar port -> [revolutions, time they changed, time of the next attempt or None]
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def check(self, lidar, now):
+        watch = self._watch.setdefault(lidar.port, [lidar.revolutions, now, None])
+        if not lidar.is_active:
+            watch[1:] = now, None
+            return
+        if watch[2] is not None:
+            if now >= watch[2]:
+                logger.warning('Restarting lidar on %s', lidar.port)
+                lidar.respawn()
+                watch[1:] = now, None
+            return
+        if lidar.revolutions != watch[0]:
+            watch[:2] = lidar.revolutions, now
+        since = now - lidar.started
+        if since < self.startup and lidar.process.is_alive():
+            return
+        is_stalled = (not lidar.process.is_alive() or now - max(lidar.heartbeat, lidar.started) > self.stall or
+                      now - max(watch[1], lidar.started) > self.revolution_timeout)
+        if is_stalled:
+            failures = self.failures.get(lidar.port, 0)
+            logger.warning('Lidar on %s stalled, attempt %d', lidar.port, failures + 1)
+            lidar.kill()
+            watch[2] = now + min(self.backoff * 2 ** failures, self.max_backoff)
+            self.failures[lidar.port] = failures + 1
+        elif since > self.recovery:
+            self.failures[lidar.port] = 0
+
+    def run(self):
+        while not self._stopped.wait(self.period):
+            now = time.time()
+            for lidar in list(self.lidars):
+                self.check(lidar, now)
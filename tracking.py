@@ -0,0 +1,112 @@
+import numpy as np
+
+
+def cluster(points, cell=250, min_points=3):
+    # points hashed into square cells; touching cells (8-neighbourhood) make one cluster, its centroid is a person
+    if len(points) == 0:
+        return np.zeros((0, 2))
+    keys = np.floor(points / cell).astype(np.int64)
+    cells, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    index = {key: k for k, key in enumerate(map(tuple, cells.tolist()))}
+    labels = np.full(len(cells), -1)
+    count = 0
+    for k, key in enumerate(index):
+        if labels[k] >= 0:
+            continue
+        labels[k] = count
+        stack = [key]
+        while stack:
+            i, j = stack.pop()
+            for di in (-1, 0, 1):
+                for dj in (-1, 0, 1):
+                    m = index.get((i + di, j + dj))
+                    if m is not None and labels[m] < 0:
+                        labels[m] = count
+                        stack.append((i + di, j + dj))
+        count += 1
+    point_labels = labels[inverse]
+    sizes = np.bincount(point_labels, minlength=count)
+    centers = np.column_stack((np.bincount(point_labels, points[:, 0], count),
+                               np.bincount(point_labels, points[:, 1], count))) / sizes[:, None]
+    return centers[sizes >= min_points]
+
+
+class Tracker:
+    # constant velocity Kalman filters, one row per person: state (x, y, vx, vy) in mm and mm/s
+    def __init__(self, cell=250, min_points=3, gate=800, noise=80, acceleration=3000, max_missed=0.5, min_hits=2):
+        self.cell = cell
+        self.min_points = min_points
+        self.gate = gate
+        self.noise = noise
+        self.acceleration = acceleration
+        self.max_missed = max_missed
+        self.min_hits = min_hits
+        self.state = np.zeros((0, 4))
+        self.covariance = np.zeros((0, 4, 4))
+        self.hits = np.zeros(0, np.int64)
+        self.seen = np.zeros(0)
+        self._time = None
+
+    def predict(self, dt):
+        transition = np.eye(4)
+        transition[0, 2] = transition[1, 3] = dt
+        g = np.array([[dt ** 2 / 2, 0], [0, dt ** 2 / 2], [dt, 0], [0, dt]])
+        self.state = self.state @ transition.T
+        self.covariance = transition @ self.covariance @ transition.T + g @ g.T * self.acceleration ** 2
+
+    def _associate(self, centers):
+        if not len(self.state) or not len(centers):
+            return [], []
+        distances = np.linalg.norm(self.state[:, None, :2] - centers[None], axis=2)
+        tracks, detections = [], []
+        for k in np.argsort(distances, axis=None).tolist():
+            t, d = divmod(k, len(centers))
+            if distances[t, d] > self.gate:
+                break
+            if t not in tracks and d not in detections:
+                tracks.append(t)
+                detections.append(d)
+        return tracks, detections
+
+    def update(self, points, now):
+        if self._time is not None:
+            self.predict(now - self._time)
+        self._time = now
+        centers = cluster(points, self.cell, self.min_points)
+        tracks, detections = self._associate(centers)
+        if tracks:
+            covariance = self.covariance[tracks]
+            innovation = covariance[:, :2, :2] + np.eye(2) * self.noise ** 2
+            gain = covariance[:, :, :2] @ np.linalg.inv(innovation)
+            residual = centers[detections] - self.state[tracks, :2]
+            self.state[tracks] += (gain @ residual[:, :, None])[:, :, 0]
+            self.covariance[tracks] = covariance - gain @ covariance[:, :2, :]
+            self.hits[tracks] += 1
+            self.seen[tracks] = now
+        new = np.setdiff1d(np.arange(len(centers)), detections)
+        if len(new):
+            state = np.zeros((len(new), 4))
+            state[:, :2] = centers[new]
+            covariance = np.tile(np.diag([self.noise ** 2] * 2 + [1500.0 ** 2] * 2), (len(new), 1, 1))
+            self.state = np.concatenate((self.state, state))
+            self.covariance = np.concatenate((self.covariance, covariance))
+            self.hits = np.concatenate((self.hits, np.ones(len(new), np.int64)))
+            self.seen = np.concatenate((self.seen, np.full(len(new), now)))
+        alive = now - self.seen <= self.max_missed
+        self.state, self.covariance = self.state[alive], self.covariance[alive]
+        self.hits, self.seen = self.hits[alive], self.seen[alive]
+
+    def cells(self, grid, horizon, steps=8):
+        # cells crossed by every confirmed person from now until horizon seconds ahead
+        marked = np.zeros((grid.height, grid.width), bool)
+        state = self.state[self.hits >= self.min_hits]
+        if not len(state):
+            return marked
+        t = np.linspace(0, horizon, steps)[:, None, None]
+        path = (state[None, :, :2] + state[None, :, 2:] * t).reshape(-1, 2)
+        j = np.floor((path[:, 0] - grid.x0) / (grid.h + 1)).astype(np.int64)
+        i = np.floor((path[:, 1] - grid.y0) / (grid.h + 1)).astype(np.int64)
+        inside = (0 <= i) & (i < grid.height) & (0 <= j) & (j < grid.width)
+        marked[i[inside], j[inside]] = True
+        return marked
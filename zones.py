@@ -0,0 +1,81 @@
+import time
+import signal
+import multiprocessing as mp
+from controller import Controller, load_settings
+from api import ApiServer, Client
+
+
+def zone_settings(settings):
+    # every zone under "zones" overrides the top level settings; without it the room is a single zone
+    zones = settings.get('zones')
+    if not zones:
+        return {None: settings}
+    common = {key: value for key, value in settings.items() if key != 'zones'}
+    return {name: {**common, **zone, 'zone': name} for name, zone in zones.items()}
+
+
+def assign_ports(zones, ports):
+    # a zone takes the ports in its "lidars" list, the first zone without one takes the ports no zone lists
+    ports = ports if isinstance(ports, dict) else dict.fromkeys(ports)
+    listed = {port for zone in zones.values() for port in zone.get('lidars', ())}
+    free = {port: hwid for port, hwid in ports.items() if port not in listed}
+    assigned = {}
+    for name, zone in zones.items():
+        if 'lidars' in zone:
+            assigned[name] = {port: ports.get(port) for port in zone['lidars']}
+        else:
+            assigned[name], free = free, {}
+    return assigned
+
+
+def run_zone(settings, ports, record, speed, api_port, metrics_port, metrics_file, stopped):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the site stops its zones
+    controller = Controller(ports, settings, record, speed, metrics_port, metrics_file)
+    api = ApiServer(controller, api_port)
+    api.start()
+    stopped.wait()
+    api.stop()
+    controller.close()
+
+
+class Site:
+    # runs every zone in its own process: its own grid, lidars, gateway and engine, and its API on
+    # api_port + the zone index; zones maps the zone names to api.Client
+    def __init__(self, ports, settings=None, record=None, speed=1.0, api_port=8765, metrics_port=None,
+                 metrics_file=None, timeout=60.0):
+        zones = zone_settings(load_settings() if settings is None else settings)
+        assigned = assign_ports(zones, ports)
+        self._stopped = mp.Event()
+        self.processes = []
+        self.zones = {}
+        for i, (name, zone) in enumerate(zones.items()):
+            process = mp.Process(target=run_zone, name='zone {}'.format(name), args=(
+                zone, assigned[name], record, speed, api_port + i, metrics_port and metrics_port + i,
+                metrics_file and (metrics_file + '.' + name if name else metrics_file), self._stopped))
+            process.start()
+            self.processes.append(process)
+        deadline = time.monotonic() + timeout
+        for i, (name, process) in enumerate(zip(zones, self.processes)):
+            self.zones[name] = self._connect('http://127.0.0.1:{}'.format(api_port + i), process, deadline)
+
+    def _connect(self, url, process, deadline):
+        while True:
+            try:
+                return Client(url)
+            except OSError:
+                if not process.is_alive() or time.monotonic() > deadline:
+                    self.close()
+                    raise RuntimeError('zone at {} did not start'.format(url))
+                time.sleep(0.2)
+
+    def status(self):
+        return {name: client.status() for name, client in self.zones.items()}
+
+    def close(self, timeout=10):
+        self._stopped.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        for client in self.zones.values():
+            client.close()